@@ -184,6 +184,7 @@ server {
         proxy_pass http://127.0.0.1:$SUBSCRIPTION_PORT;
         proxy_http_version 1.1;
         proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
     }
 }
 EOF
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Load benchmark - latency, throughput and memory of the subscription service
+
+Generates users.json/nodes.json at each scale, starts scalable-sub.py as a
+master and as a client (synced from a local stub master), drives each
+endpoint with concurrent keep-alive clients and reports p50/p99 latency,
+requests per second and RSS. Also times XUISync.get_xui_users against a
+generated x-ui.db of the same size.
+
+Usage: python3 bench/bench_load.py [--sizes 1000,10000,100000] [--duration 5]
+                                   [--concurrency 8] [--server dev|gunicorn]
+                                   [--json] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import requests
+
+from common import (SERVICE_PATH, git_revision, load_xui_sync, make_nodes, make_users,
+                    make_xui_db, percentile, rss_kb, write_data_dir)
+
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+API_KEY = 'bench-api-key'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class StubMaster:
+    """Serves a fixed full snapshot on /api/v1/sync, like a master that never changes"""
+
+    def __init__(self, users, nodes):
+        body = json.dumps({
+            "mode": "full", "epoch": "benchepoch00", "revision": 1,
+            "users": users, "nodes": nodes, "timestamp": time.time()
+        }).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if not self.path.startswith('/api/v1/sync'):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ServiceProcess:
+    """scalable-sub.py running in a child process"""
+
+    def __init__(self, node_type, data_dir, server, master_api=None):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ,
+                   NODE_TYPE=node_type,
+                   NODE_NAME=f"bench-{node_type}",
+                   DATA_DIR=data_dir,
+                   PORT=str(self.port),
+                   JWT_SECRET=JWT_SECRET,
+                   API_KEY=API_KEY,
+                   SERVER_MODE=server,
+                   HEALTH_CHECKS='false',
+                   # Load comes from one IP at thousands of requests per second
+                   RATE_LIMIT='false',
+                   # One initial sync, no refreshes while we measure
+                   PUSH_UPDATES='false',
+                   CACHE_TTL='86400',
+                   MASTER_API=master_api or 'http://127.0.0.1:9')
+        started = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, SERVICE_PATH], env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.startup_s = self.wait_ready(started)
+
+    def wait_ready(self, started, timeout=120):
+        """Seconds until /health answers with users loaded"""
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"service exited with status {self.process.returncode}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=5).json().get('users'):
+                    return round(time.perf_counter() - started, 3)
+            except (requests.RequestException, ValueError):
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("service did not become ready")
+
+    def rss_mb(self):
+        return round(rss_kb(self.process.pid) / 1024, 1)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+def sync_token():
+    payload = {'node': 'bench', 'exp': datetime.utcnow() + timedelta(hours=1)}
+    return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+
+def endpoints(node_type, usernames, base_url):
+    """name -> function(rng) returning (path, headers) for one request"""
+    plan = {
+        'sub': lambda rng: (f"/sub/{rng.choice(usernames)}", {}),
+        'sub_raw': lambda rng: (f"/sub/{rng.choice(usernames)}/raw", {}),
+        'sub_missing': lambda rng: (f"/sub/nouser{rng.randrange(10 ** 6)}", {}),
+        'health': lambda rng: ("/health", {}),
+        'metrics': lambda rng: ("/metrics", {}),
+    }
+    # Conditional GETs replay the ETag a subscriber got last time
+    etags = {}
+    for username in usernames[:200]:
+        response = requests.get(f"{base_url}/sub/{username}", timeout=30)
+        etags[username] = response.headers.get('ETag', '')
+    conditional = list(etags.items())
+
+    def sub_not_modified(rng):
+        username, etag = rng.choice(conditional)
+        return f"/sub/{username}", {'If-None-Match': etag}
+    plan['sub_304'] = sub_not_modified
+
+    if node_type == 'master':
+        auth = {'Authorization': f"Bearer {sync_token()}"}
+        current = requests.get(f"{base_url}/api/v1/sync", headers=auth, timeout=60).json()
+        since = {'since': current['revision'], 'epoch': current['epoch']}
+        query = '&'.join(f"{key}={value}" for key, value in since.items())
+        plan['sync_full'] = lambda rng: ("/api/v1/sync", dict(auth, **{'Accept-Encoding': 'gzip'}))
+        plan['sync_delta'] = lambda rng: (f"/api/v1/sync?{query}", auth)
+        plan['users_list'] = lambda rng: ("/api/v1/users", {'X-API-Key': API_KEY})
+    return plan
+
+def drive(base_url, make_request, duration, concurrency):
+    """Run concurrent keep-alive clients for `duration` seconds"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            path, headers = make_request(rng)
+            start = time.perf_counter()
+            try:
+                response = session.get(base_url + path, headers=headers, timeout=60)
+                response.content
+                if response.status_code >= 500:
+                    failed += 1
+            except requests.RequestException:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+def bench_service(node_type, count, users, nodes, workdir, args):
+    """Start one service process and measure every endpoint against it"""
+    data_dir = os.path.join(workdir, node_type)
+    stub = None
+    if node_type == 'master':
+        write_data_dir(data_dir, users, nodes)
+    else:
+        os.makedirs(data_dir, exist_ok=True)
+        stub = StubMaster(users, nodes)
+    service = ServiceProcess(node_type, data_dir, args.server, stub.url if stub else None)
+    rows = []
+    try:
+        usernames = list(users)
+        base = {'scenario': 'http', 'mode': node_type, 'users': count, 'server': args.server}
+        rows.append(dict(base, endpoint='startup', startup_s=service.startup_s, rss_mb=service.rss_mb()))
+        for name, make_request in endpoints(node_type, usernames, service.url).items():
+            if args.endpoints and name not in args.endpoints:
+                continue
+            drive(service.url, make_request, min(1.0, args.duration), args.concurrency)  # warm-up
+            result = drive(service.url, make_request, args.duration, args.concurrency)
+            rows.append(dict(base, endpoint=name, concurrency=args.concurrency, rss_mb=service.rss_mb(), **result))
+            log(args, rows[-1])
+    finally:
+        service.stop()
+        if stub:
+            stub.close()
+    return rows
+
+def bench_xui(count, users, workdir, repeat=5):
+    """Time XUISync.get_xui_users against an x-ui.db with `count` clients"""
+    xui_sync = load_xui_sync()
+    db_path = os.path.join(workdir, 'x-ui.db')
+    make_xui_db(db_path, users)
+    sync = xui_sync.XUISync()
+    sync.xui_db = db_path
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = sync.get_xui_users()
+        timings.append(time.perf_counter() - start)
+    assert len(found) == count
+    timings.sort()
+    return {
+        'scenario': 'xui_db', 'users': count, 'endpoint': 'get_xui_users',
+        'runs': repeat,
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 3),
+        'max_ms': round(timings[-1] * 1000, 3),
+        'db_bytes': os.path.getsize(db_path)
+    }
+
+def log(args, row):
+    """Progress on stderr so --json output stays clean"""
+    if args.json:
+        print(f"  {row}", file=sys.stderr)
+
+def print_table(rows):
+    print(f"{'scenario':<8} {'mode':<7} {'users':>8} {'endpoint':<14} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8}")
+    for row in rows:
+        if row['endpoint'] == 'startup':
+            print(f"{row['scenario']:<8} {row['mode']:<7} {row['users']:>8} {'startup':<14} "
+                  f"{'':>9} {row['startup_s'] * 1000:>9.1f} {'':>9} {row['rss_mb']:>8}")
+        elif row['scenario'] == 'xui_db':
+            print(f"{'xui_db':<8} {'':<7} {row['users']:>8} {row['endpoint']:<14} "
+                  f"{'':>9} {row['p50_ms']:>9} {row['max_ms']:>9} {'':>8}")
+        else:
+            print(f"{row['scenario']:<8} {row['mode']:<7} {row['users']:>8} {row['endpoint']:<14} "
+                  f"{row['rps']:>9} {row['p50_ms']:>9} {row['p99_ms']:>9} {row['rss_mb']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated user counts')
+    parser.add_argument('--nodes', type=int, default=8, help='nodes in nodes.json')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent keep-alive clients')
+    parser.add_argument('--server', choices=['dev', 'gunicorn'], default='dev', help='SERVER_MODE to run')
+    parser.add_argument('--modes', default='master,client', help='node types to start')
+    parser.add_argument('--endpoints', help='comma-separated subset of endpoints to drive')
+    parser.add_argument('--no-xui', action='store_true', help='skip the x-ui.db read benchmark')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+    args.endpoints = set(args.endpoints.split(',')) if args.endpoints else None
+
+    workdir = tempfile.mkdtemp(prefix='vpnsub-load-')
+    rows = []
+    try:
+        for count in (int(size) for size in args.sizes.split(',')):
+            users = make_users(count)
+            nodes = make_nodes(args.nodes)
+            for node_type in args.modes.split(','):
+                rows.extend(bench_service(node_type, count, users, nodes, os.path.join(workdir, str(count)), args))
+            if not args.no_xui:
+                rows.append(bench_xui(count, users, workdir))
+                log(args, rows[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_revision(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': {'duration': args.duration, 'concurrency': args.concurrency,
+                     'server': args.server, 'nodes': args.nodes},
+        'results': rows
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_table(rows)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Render benchmark - subscription bodies per second for many users x many nodes
+
+Compares compiled link templates (what /sub/<user> uses) with building every
+link from its inbound spec, across a mix of vless/vmess/trojan inbounds.
+
+Usage: python3 bench/bench_render.py [--users 10000] [--nodes 1,10,50]
+                                     [--inbounds 3] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('NODE_TYPE', 'client')
+os.environ.setdefault('HEALTH_CHECKS', 'false')
+
+from common import load_service, make_nodes, make_users
+
+# Cycled over each node's inbounds
+INBOUND_MIX = [
+    {'protocol': 'vless', 'port': 8443, 'network': 'tcp', 'security': 'tls', 'alpn': 'h2,http/1.1'},
+    {'protocol': 'vmess', 'port': 443, 'network': 'ws', 'security': 'tls', 'path': '/ws'},
+    {'protocol': 'trojan', 'port': 2053, 'network': 'grpc', 'security': 'tls', 'service_name': 'tr'},
+    {'protocol': 'vless', 'port': 80, 'network': 'ws', 'security': 'none', 'path': '/v'},
+]
+
+def make_inbound_nodes(count, inbounds):
+    nodes = make_nodes(count)
+    for node in nodes:
+        node['inbounds'] = [INBOUND_MIX[i % len(INBOUND_MIX)] for i in range(inbounds)]
+    return nodes
+
+def bench(service, users, nodes):
+    renderer = service.SubscriptionRenderer
+    builder = service.LinkBuilder
+    links = sum(len(builder.specs(node)) for node in nodes) * len(users)
+
+    # Links are compiled when a node set is published
+    start = time.perf_counter()
+    snapshot = service.Snapshot(service.UserTable(users), nodes, service.content_version(nodes), None, 0, time.time())
+    compile_ms = (time.perf_counter() - start) * 1000
+    service.Snapshot.publish(snapshot)
+
+    renderer.rendered.clear()
+    start = time.perf_counter()
+    for user, client_id in users.items():
+        renderer.render(user, client_id)
+    compiled = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user, client_id in users.items():
+        renderer.render(user, client_id)
+    cached = time.perf_counter() - start
+
+    # The same bodies with every link built from its spec, no templates
+    start = time.perf_counter()
+    for user, client_id in users.items():
+        lines = []
+        for index in service.NodeRanker.order(user, snapshot.records, None):
+            specs = builder.specs(nodes[index])
+            for spec in specs:
+                lines.append(builder.link(nodes[index], spec, builder.label(nodes[index], spec, len(specs)), client_id))
+        '\n'.join(lines)
+    uncompiled = time.perf_counter() - start
+
+    return {
+        'users': len(users),
+        'nodes': len(nodes),
+        'links': links,
+        'compile_ms': round(compile_ms, 2),
+        'compiled_renders_per_s': round(len(users) / compiled),
+        'compiled_links_per_s': round(links / compiled),
+        'uncompiled_renders_per_s': round(len(users) / uncompiled),
+        'cached_renders_per_s': round(len(users) / cached),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='users rendered per run')
+    parser.add_argument('--nodes', default='1,10,50', help='comma-separated node counts')
+    parser.add_argument('--inbounds', type=int, default=3, help='inbounds per node')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    args = parser.parse_args()
+
+    service = load_service()
+    users = make_users(args.users)
+    rows = [bench(service, users, make_inbound_nodes(int(count), args.inbounds)) for count in args.nodes.split(',')]
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'users':>7} {'nodes':>6} {'links':>9} {'compiled/s':>11} {'links/s':>10} {'uncompiled/s':>13} {'cached/s':>9}")
+    for row in rows:
+        print(f"{row['users']:>7} {row['nodes']:>6} {row['links']:>9} {row['compiled_renders_per_s']:>11} "
+              f"{row['compiled_links_per_s']:>10} {row['uncompiled_renders_per_s']:>13} {row['cached_renders_per_s']:>9}")
+
+if __name__ == '__main__':
+    sys.exit(main())
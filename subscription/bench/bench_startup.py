@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark - how soon a restarted client node serves subscriptions
+
+For each user count, times decoding the warm-start snapshot against the
+other ways a node can get its users (users.json, a binary sync snapshot),
+then starts scalable-sub.py as a client and measures the time until it
+serves users: from its warm-start file with the master down, and cold
+from a local stub master.
+
+Usage: python3 bench/bench_startup.py [--sizes 10000,100000,1000000]
+                                      [--server dev|gunicorn] [--json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from common import load_service, make_nodes, make_users
+from bench_load import ServiceProcess, StubMaster
+
+def best_of(runs, fn):
+    """Fastest of several runs of fn(), in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return round(min(timings) * 1000, 1)
+
+def bench_decode(service, users, nodes):
+    warm = service.WarmStart.encode(users, nodes, 'benchepoch00', 1, time.time())
+    sync = service.pack_snapshot({'mode': 'full', 'epoch': 'benchepoch00', 'revision': 1, 'users': users, 'nodes': nodes})
+    users_json = json.dumps(users).encode()
+    runs = 3 if len(users) < 500000 else 1
+    return {
+        'warm_bytes': len(warm),
+        'warm_encode_ms': best_of(runs, lambda: service.WarmStart.encode(users, nodes, 'benchepoch00', 1, time.time())),
+        'warm_load_ms': best_of(runs, lambda: service.WarmStart.decode(warm)),
+        'sync_snapshot_ms': best_of(runs, lambda: service.unpack_snapshot(sync)),
+        'users_json_ms': best_of(runs, lambda: json.loads(users_json)),
+    }
+
+def bench_serving(service, users, nodes, server):
+    """Seconds until /health reports users, warm (master down) and cold (stub master)"""
+    result = {}
+    data_dir = tempfile.mkdtemp(prefix='vpnsub-bench-startup-')
+    try:
+        with open(os.path.join(data_dir, 'warm-snapshot.bin'), 'wb') as f:
+            f.write(service.WarmStart.encode(users, nodes, 'benchepoch00', 1, time.time()))
+        process = ServiceProcess('client', data_dir, server)
+        result['warm_ready_s'] = process.startup_s
+        process.stop()
+
+        os.unlink(os.path.join(data_dir, 'warm-snapshot.bin'))
+        master = StubMaster(users, nodes)
+        try:
+            process = ServiceProcess('client', data_dir, server, master.url)
+            result['cold_ready_s'] = process.startup_s
+            process.stop()
+        finally:
+            master.close()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated user counts')
+    parser.add_argument('--server', choices=['dev', 'gunicorn'], default='dev')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    args = parser.parse_args()
+
+    service = load_service()
+    nodes = make_nodes(10)
+    rows = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        users = make_users(size)
+        row = {'users': size}
+        row.update(bench_decode(service, users, nodes))
+        row.update(bench_serving(service, users, nodes, args.server))
+        rows.append(row)
+        if not args.json:
+            print(f"{size:>8} users: warm file {row['warm_bytes'] / 1e6:.1f} MB, "
+                  f"load {row['warm_load_ms']} ms (sync snapshot {row['sync_snapshot_ms']} ms, "
+                  f"users.json {row['users_json_ms']} ms, write {row['warm_encode_ms']} ms); "
+                  f"serving after {row['warm_ready_s']} s warm, {row['cold_ready_s']} s cold")
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+if __name__ == '__main__':
+    sys.exit(main())
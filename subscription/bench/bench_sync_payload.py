@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Sync payload benchmark - size and decode time of full snapshots, JSON vs binary
+
+Usage: python3 bench/bench_sync_payload.py [--sizes 10000,100000,1000000] [--json]
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import time
+
+from common import load_service, make_users
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def make_snapshot(count):
+    """Full sync payload with count users carrying random UUIDs"""
+    return {
+        "mode": "full",
+        "epoch": "0123456789ab",
+        "revision": count,
+        "users": make_users(count),
+        "nodes": [
+            {"name": "Finland", "host": "freedomacrossborders.shop", "port": 8443, "region": "EU", "capacity": 1000},
+            {"name": "Bahrain", "host": "bahrain.freedomacrossborders.shop", "port": 8443, "region": "ME", "capacity": 500}
+        ],
+        "timestamp": time.time()
+    }
+
+def timed(func, *args, repeat=3):
+    """Best-of-N wall time in milliseconds, plus the last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_size(service, count):
+    snapshot = make_snapshot(count)
+    formats = {
+        'json': (lambda s: json.dumps(s, separators=(',', ':')).encode(), json.loads),
+        'binary': (service.pack_snapshot, service.unpack_snapshot),
+    }
+    codecs = {'identity': (lambda b: b, lambda b: b), 'gzip': (lambda b: gzip.compress(b, 5), gzip.decompress)}
+    if zstandard:
+        codecs['zstd'] = (zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress)
+
+    rows = []
+    for format_name, (encode, decode) in formats.items():
+        encode_ms, body = timed(encode, snapshot)
+        for codec_name, (compress, decompress) in codecs.items():
+            compress_ms, wire = timed(compress, body)
+            # Client side: decompress and decode into the user dict
+            decode_ms, decoded = timed(lambda w: decode(decompress(w)), wire)
+            assert decoded['users'] == snapshot['users']
+            rows.append({
+                'users': count,
+                'format': format_name,
+                'encoding': codec_name,
+                'bytes': len(wire),
+                'encode_ms': round(encode_ms + compress_ms, 1),
+                'decode_ms': round(decode_ms, 1)
+            })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated user counts')
+    parser.add_argument('--json', action='store_true', help='print machine-readable JSON')
+    args = parser.parse_args()
+
+    service = load_service()
+    rows = []
+    for count in (int(size) for size in args.sizes.split(',')):
+        rows.extend(bench_size(service, count))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    baseline = {row['users']: row['bytes'] for row in rows if row['format'] == 'json' and row['encoding'] == 'identity'}
+    print(f"{'users':>9} {'format':<7} {'encoding':<9} {'bytes':>12} {'vs json':>8} {'encode ms':>10} {'decode ms':>10}")
+    for row in rows:
+        ratio = row['bytes'] / baseline[row['users']]
+        print(f"{row['users']:>9} {row['format']:<7} {row['encoding']:<9} {row['bytes']:>12} {ratio:>7.1%} "
+              f"{row['encode_ms']:>10} {row['decode_ms']:>10}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the benchmarks - synthetic data and loading the service modules
+"""
+
+import importlib.util
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import uuid
+
+SUBSCRIPTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_PATH = os.path.join(SUBSCRIPTION_DIR, 'scalable-sub.py')
+
+def load_service():
+    """Import scalable-sub.py (its name isn't importable) as a module"""
+    os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='vpnsub-bench-'))
+    spec = importlib.util.spec_from_file_location('scalable_sub', SERVICE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_xui_sync():
+    """Import sync/xui_sync.py, which expects its own directory on sys.path"""
+    sys.path.insert(0, os.path.join(SUBSCRIPTION_DIR, 'sync'))
+    import xui_sync
+    return xui_sync
+
+def make_users(count, seed=1):
+    """Deterministic {username: uuid} with random-looking UUIDs"""
+    rng = random.Random(seed)
+    return {
+        f"user{i:07d}": str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        for i in range(count)
+    }
+
+def make_nodes(count):
+    """nodes.json entries split between two regions"""
+    return [
+        {
+            "name": f"node{i:03d}",
+            "host": f"node{i:03d}.example.com",
+            "port": 8443,
+            "region": "EU" if i % 2 else "ME",
+            "capacity": 1000,
+            "load": (i * 37) % 800
+        }
+        for i in range(count)
+    ]
+
+def write_data_dir(path, users, nodes):
+    """Lay out a DATA_DIR the way the master expects it"""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'users.json'), 'w') as f:
+        json.dump(users, f)
+    with open(os.path.join(path, 'nodes.json'), 'w') as f:
+        json.dump(nodes, f)
+
+def make_xui_db(path, users, inbounds=4):
+    """Write an x-ui.db with users spread across a few inbounds"""
+    if os.path.exists(path):
+        os.unlink(path)
+    conn = sqlite3.connect(path)
+    # The columns of x-ui's inbounds table that the sync tools read
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, remark TEXT, enable INTEGER, listen TEXT, "
+                 "port INTEGER, protocol TEXT, settings TEXT, stream_settings TEXT, tag TEXT)")
+    names = list(users)
+    for index in range(inbounds):
+        clients = [
+            {"id": users[name], "email": f"{name}@vpn", "flow": "", "enable": True}
+            for name in names[index::inbounds]
+        ]
+        conn.execute("INSERT INTO inbounds VALUES (?, ?, 1, '', ?, 'vless', ?, ?, ?)",
+                     (index + 1, f"bench-{index}", 8443 + index,
+                      json.dumps({"clients": clients, "decryption": "none"}),
+                      json.dumps({"network": "tcp", "security": "tls", "tlsSettings": {"alpn": ["h2", "http/1.1"]}}),
+                      f"inbound-{8443 + index}"))
+    conn.commit()
+    conn.close()
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def process_tree(pid):
+    """pid plus all of its descendants (gunicorn workers)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; fields resume after ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+def rss_kb(pid):
+    """Resident set size of a process and its children, in KiB"""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return total
+
+def git_revision():
+    """Current commit, so results can be compared across commits"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SUBSCRIPTION_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
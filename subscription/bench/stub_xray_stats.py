@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Stub xray stats API - serves growing traffic counters for synthetic users over gRPC
+
+Stands in for xray's StatsService when trying the traffic collector locally.
+Needs grpcio. Point a node at it with STATS_COLLECT=true XRAY_API=127.0.0.1:<port>.
+
+Usage: python3 bench/stub_xray_stats.py [--port 62789] [--users 1000] [--active 0.1]
+                                        [--reset-every 0]
+"""
+
+import argparse
+import random
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+def varint(value):
+    """Encode a non-negative int as a protobuf varint"""
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def encode_stat(name, value):
+    """Stat{name = 1, value = 2}"""
+    name = name.encode()
+    return b'\x0a' + varint(len(name)) + name + b'\x10' + varint(value)
+
+def encode_response(counters):
+    """QueryStatsResponse{repeated Stat stat = 1}"""
+    out = bytearray()
+    for name, value in counters.items():
+        stat = encode_stat(name, value)
+        out += b'\x0a' + varint(len(stat)) + stat
+    return bytes(out)
+
+class Counters:
+    """Synthetic counters: a share of users move traffic, a few of them heavily"""
+
+    def __init__(self, users, active, reset_every):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.users = [f"user{i:07d}@vpn" for i in range(users)]
+        self.active = self.users[:max(1, int(users * active))]
+        self.reset_every = reset_every
+        self.last_reset = time.time()
+        self.last_tick = time.time()
+
+    def tick(self):
+        """Advance counters by the time since the last query"""
+        now = time.time()
+        elapsed, self.last_tick = now - self.last_tick, now
+        if self.reset_every and now - self.last_reset >= self.reset_every:
+            # What the x-ui panel does when it reads with reset
+            self.values.clear()
+            self.last_reset = now
+        for rank, email in enumerate(self.active):
+            down = int(elapsed * random.uniform(0.5, 1.5) * 200000 / (rank + 1))
+            up = down // 10
+            for direction, amount in (('uplink', up), ('downlink', down)):
+                name = f"user>>>{email}>>>traffic>>>{direction}"
+                self.values[name] = self.values.get(name, 0) + amount
+                inbound = f"inbound>>>inbound-8443>>>traffic>>>{direction}"
+                self.values[inbound] = self.values.get(inbound, 0) + amount
+
+    def query(self, request, context):
+        with self.lock:
+            self.tick()
+            return encode_response(self.values)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=62789)
+    parser.add_argument('--users', type=int, default=1000, help='users with counters')
+    parser.add_argument('--active', type=float, default=0.1, help='share of users moving traffic')
+    parser.add_argument('--reset-every', type=float, default=0, help='reset counters every N seconds, like x-ui does')
+    args = parser.parse_args()
+
+    counters = Counters(args.users, args.active, args.reset_every)
+    handler = grpc.method_handlers_generic_handler('xray.app.stats.command.StatsService', {
+        'QueryStats': grpc.unary_unary_rpc_method_handler(counters.query)
+    })
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    server.add_generic_rpc_handlers((handler,))
+    server.add_insecure_port(f"127.0.0.1:{args.port}")
+    server.start()
+    print(f"Stub stats API on 127.0.0.1:{args.port} with {len(counters.active)} active users")
+    server.wait_for_termination()
+
+if __name__ == '__main__':
+    main()
@@ -27,12 +27,14 @@ JWT_SECRET=$JWT_SECRET
 API_KEY=$API_KEY
 CACHE_TTL=300
 PORT=5000
+SERVER_MODE=gunicorn
+STATS_COLLECT=true
 EOF
     echo "Created .env file with secure keys"
 fi
 
 # Install dependencies
-pip3 install flask requests pyjwt
+pip3 install flask requests pyjwt gunicorn
 
 # Create systemd service
 cat > /etc/systemd/system/vpn-scalable.service << EOF
@@ -48,6 +50,8 @@ EnvironmentFile=/opt/vpn-subscription/.env
 ExecStart=/usr/bin/python3 /opt/vpn-subscription/scalable-sub.py
 Restart=always
 RestartSec=10
+# Each keep-alive subscriber holds a file descriptor
+LimitNOFILE=65536
 
 [Install]
 WantedBy=multi-user.target
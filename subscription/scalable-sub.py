@@ -3,164 +3,2780 @@
 Scalable VPN subscription service with Redis caching and JWT authentication
 """
 
-from flask import Flask, Response, jsonify, request
+from flask import Flask, Response, jsonify, request, g
 import base64
 import json
 import os
 import time
 import jwt
 import requests
+import requests.adapters
+import urllib3
+import urllib3.connection
 from datetime import datetime, timedelta
 import hashlib
+import gzip
+import zlib
+import re
+import struct
+import fcntl
+import threading
+import random
+import math
+import ipaddress
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from urllib.parse import quote
+
+try:
+    import zstandard
+except ImportError:
+    # Optional: zstd is offered only when the zstandard package is installed
+    zstandard = None
+try:
+    import httpx
+    import h2
+except ImportError:
+    # Optional: HTTP/2 to the master needs both httpx and h2; requests pools HTTP/1.1 otherwise
+    httpx = None
+try:
+    import grpc
+except ImportError:
+    # Optional: without grpcio the xray stats are read through the xray CLI
+    grpc = None
+from collections import deque, OrderedDict
 
 app = Flask(__name__)
 
+PROCESS_START = time.time()
+
 # Configuration from environment
 CONFIG = {
-    'NODE_TYPE': os.environ.get('NODE_TYPE', 'client'),  # 'master' or 'client'
+    'NODE_TYPE': os.environ.get('NODE_TYPE', 'client'),  # 'master', 'replica' or 'client'
     'NODE_NAME': os.environ.get('NODE_NAME', 'Bahrain'),
     'NODE_HOST': os.environ.get('NODE_HOST', '154.205.146.39'),
-    'MASTER_API': os.environ.get('MASTER_API', 'https://freedomacrossborders.shop:5000'),
+    'MASTER_API': os.environ.get('MASTER_API', 'https://freedomacrossborders.shop:5000'),  # comma-separated for failover
     'JWT_SECRET': os.environ.get('JWT_SECRET', 'change-this-secret-key-in-production'),
     'API_KEY': os.environ.get('API_KEY', 'your-api-key-here'),
     'CACHE_TTL': int(os.environ.get('CACHE_TTL', '300')),  # 5 minutes cache
-    'PORT': int(os.environ.get('PORT', '5000'))
+    'DATA_DIR': os.environ.get('DATA_DIR', '/opt/vpn-subscription'),
+    'COMPACT_THRESHOLD': int(os.environ.get('COMPACT_THRESHOLD', '1000')),  # log entries before compaction
+    'CHANGELOG_SIZE': int(os.environ.get('CHANGELOG_SIZE', '10000')),  # revisions kept for delta sync
+    'PUSH_UPDATES': os.environ.get('PUSH_UPDATES', 'true').lower() == 'true',  # long-poll the master for changes
+    'LONG_POLL_TIMEOUT': int(os.environ.get('LONG_POLL_TIMEOUT', '30')),  # seconds a sync request may be held open
+    'LONG_POLL_WAITERS': int(os.environ.get('LONG_POLL_WAITERS', '256')),  # long-polls a master/replica holds at once; at least the client host count
+    'FEED_CHECK_INTERVAL': float(os.environ.get('FEED_CHECK_INTERVAL', '0.5')),  # seconds between sibling workers' change checks
+    'SYNC_BACKOFF_MAX': int(os.environ.get('SYNC_BACKOFF_MAX', '300')),  # cap on retry delay while master is down
+    'PORT': int(os.environ.get('PORT', '5000')),
+    'SYNC_BINARY': os.environ.get('SYNC_BINARY', 'true').lower() == 'true',  # request compact binary snapshots
+    'SERVER_MODE': os.environ.get('SERVER_MODE', 'dev'),  # 'dev' (Flask server) or 'gunicorn' (prefork workers)
+    'WORKERS': int(os.environ.get('WORKERS', '0')),  # 0 = one per core on clients, always 1 on the master
+    'THREADS': int(os.environ.get('THREADS', '32')),  # request threads per worker
+    'WORKER_CONNECTIONS': int(os.environ.get('WORKER_CONNECTIONS', '4000')),  # open connections per worker
+    'KEEPALIVE': int(os.environ.get('KEEPALIVE', '75')),  # seconds an idle keep-alive connection is kept
+    'GEOIP_DB': os.environ.get('GEOIP_DB', ''),  # optional MaxMind country database for requester regions
+    'REGION_COUNTRIES': os.environ.get('REGION_COUNTRIES', 'EU:FI,SE,NO,DK,DE,NL,FR,GB,PL;ME:BH,AE,SA,QA,KW,OM,IR,IQ,TR'),
+    'REGION_BOOST': float(os.environ.get('REGION_BOOST', '4')),  # weight multiplier for nodes in the requester's region
+    'SUB_MAX_NODES': int(os.environ.get('SUB_MAX_NODES', '0')),  # nodes per subscription, 0 = all
+    'HEALTH_CHECKS': os.environ.get('HEALTH_CHECKS', 'true').lower() == 'true',  # probe nodes in the background
+    'HEALTH_INTERVAL': int(os.environ.get('HEALTH_INTERVAL', '15')),  # seconds between probe rounds
+    'HEALTH_TIMEOUT': float(os.environ.get('HEALTH_TIMEOUT', '3')),  # seconds per probe
+    'HEALTH_TLS': os.environ.get('HEALTH_TLS', 'true').lower() == 'true',  # complete a TLS handshake, not just TCP
+    'HEALTH_FALL': int(os.environ.get('HEALTH_FALL', '3')),  # consecutive failures before a node is dropped
+    'HEALTH_RISE': int(os.environ.get('HEALTH_RISE', '2')),  # consecutive successes before it is restored
+    'HEALTH_SLOW_MS': int(os.environ.get('HEALTH_SLOW_MS', '1000')),  # handshakes slower than this demote a node
+    'RATE_LIMIT': os.environ.get('RATE_LIMIT', 'true').lower() == 'true',  # token buckets on /sub/<user>
+    'RATE_LIMIT_USER_PER_MIN': float(os.environ.get('RATE_LIMIT_USER_PER_MIN', '10')),  # refill per username
+    'RATE_LIMIT_USER_BURST': int(os.environ.get('RATE_LIMIT_USER_BURST', '20')),
+    'RATE_LIMIT_IP_PER_MIN': float(os.environ.get('RATE_LIMIT_IP_PER_MIN', '120')),  # refill per source IP, covers CGNAT
+    'RATE_LIMIT_IP_BURST': int(os.environ.get('RATE_LIMIT_IP_BURST', '120')),
+    'RATE_LIMIT_ENTRIES': int(os.environ.get('RATE_LIMIT_ENTRIES', '100000')),  # buckets kept in memory per scope
+    'RATE_LIMIT_REDIS': os.environ.get('RATE_LIMIT_REDIS', ''),  # e.g. redis://localhost:6379/0 to share limits
+    'NEGATIVE_CACHE_SIZE': int(os.environ.get('NEGATIVE_CACHE_SIZE', '100000')),  # unknown usernames remembered
+    'NEGATIVE_CACHE_TTL': int(os.environ.get('NEGATIVE_CACHE_TTL', '60')),  # seconds, also dropped on any user change
+    'STATS_COLLECT': os.environ.get('STATS_COLLECT', 'false').lower() == 'true',  # read xray traffic counters
+    'XRAY_API': os.environ.get('XRAY_API', '127.0.0.1:62789'),
+    'XRAY_BIN': os.environ.get('XRAY_BIN', '/usr/local/x-ui/bin/xray-linux-amd64'),  # used when grpcio is missing
+    'STATS_INTERVAL': int(os.environ.get('STATS_INTERVAL', '10')),  # seconds between counter reads
+    'STATS_SLOT_SECONDS': int(os.environ.get('STATS_SLOT_SECONDS', '60')),  # one ring slot, and one report, per this
+    'STATS_SLOTS': int(os.environ.get('STATS_SLOTS', '15')),  # slots kept; window = slots * slot seconds
+    'STATS_TOP_USERS': int(os.environ.get('STATS_TOP_USERS', '50')),  # users listed per report
+    'EXPORT_DIR': os.environ.get('EXPORT_DIR', ''),  # write static subscription files here for nginx, '' = off
+    'EXPORT_GZIP': os.environ.get('EXPORT_GZIP', 'true').lower() == 'true',  # also write .gz files for gzip_static
+    'EXPORT_INTERVAL': float(os.environ.get('EXPORT_INTERVAL', '1')),  # seconds between change checks
+    'SYNC_HTTP2': os.environ.get('SYNC_HTTP2', 'true').lower() == 'true',  # HTTP/2 to the master if httpx and h2 are installed
+    'SYNC_POOL_SIZE': int(os.environ.get('SYNC_POOL_SIZE', '8')),  # pooled connections to the master
+    'TOKEN_TTL': int(os.environ.get('TOKEN_TTL', '300')),  # lifetime of the JWTs we mint
+    'TOKEN_REFRESH_MARGIN': int(os.environ.get('TOKEN_REFRESH_MARGIN', '60')),  # mint a new one this long before expiry
+    'TOKEN_CACHE_SIZE': int(os.environ.get('TOKEN_CACHE_SIZE', '1024')),  # verified tokens remembered by the master
+    'WARM_START': os.environ.get('WARM_START', 'true').lower() == 'true',  # keep a local snapshot to serve from after restarts
+    'WARM_START_INTERVAL': int(os.environ.get('WARM_START_INTERVAL', '60')),  # at most one snapshot write per this many seconds
+    'WARM_START_MAX_AGE': int(os.environ.get('WARM_START_MAX_AGE', '604800')),  # ignore older snapshots, 0 = no limit
+    'WATCH_INTERVAL': float(os.environ.get('WATCH_INTERVAL', '1'))  # seconds between master checks of nodes.json/users.json, 0 = off
+}
+
+# Sync scheduling state; users and nodes live in Snapshot.current
+CACHE = {
+    'refresh_at': 0,
+    'source_index': 0
+}
+
+# Serialises snapshot writers (syncs, user writes, file reloads); readers never take it
+SYNC_LOCK = threading.Lock()
+
+# Parsed JSON files keyed by path: (stat signature, data, content version)
+FILE_CACHE = {}
+
+def file_signature(path):
+    """(mtime, size, inode) of a file, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def load_json_file(path):
+    """Load a JSON file, re-parsing only when it changed on disk"""
+    signature = file_signature(path)
+    if signature is None:
+        raise FileNotFoundError(path)
+    cached = FILE_CACHE.get(path)
+    if cached and cached[0] == signature:
+        return cached[1], cached[2]
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = json.loads(raw)
+    version = hashlib.sha1(raw).hexdigest()[:16]
+    FILE_CACHE[path] = (signature, data, version)
+    return data, version
+
+def replace_file(path, write, durable, mode=None):
+    """Write through write(file) to a temp file of its own beside path and rename it over path
+
+    Each write gets a unique temp name, so concurrent writers (even in
+    different processes) can't interleave in one temp file; the last
+    rename wins. With durable the data is fsynced before the rename.
+    mode None keeps the permissions of the file being replaced.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory or '.')
+    try:
+        if mode is None:
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+        # mkstemp creates the file 0600; keep the permissions readers (nginx) expect
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_json_atomic(path, data):
+    """Durably write JSON over path, never leaving a half-written file"""
+    replace_file(path, lambda f: f.write(json.dumps(data, indent=2).encode()), durable=True)
+
+def write_file_atomic(path, data):
+    """Write bytes over path through a hidden temp file
+
+    Not fsynced: everything written this way can be regenerated, and is
+    world-readable so nginx can serve exported files.
+    """
+    replace_file(path, lambda f: f.write(data), durable=False, mode=0o644)
+
+# Lock files held for the life of the process, by name
+HOST_LOCKS = {}
+
+def host_lock(name):
+    """True if this process holds DATA_DIR/<name>.lock, taking it if it is free
+
+    Picks one gunicorn worker per host for a background job. The lock is
+    released when its process exits, and then another worker takes over.
+    """
+    if name in HOST_LOCKS:
+        return True
+    lock_file = open(os.path.join(CONFIG['DATA_DIR'], f"{name}.lock"), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    HOST_LOCKS[name] = lock_file
+    return True
+
+# Binary full-snapshot format (version 1):
+#   b'VSNP', struct '<BIII' (version, header length, names length, uuids length),
+#   JSON header (every snapshot field except users, plus 'count' and 'loose'),
+#   usernames joined by NUL as one UTF-8 string table,
+#   UUIDs packed as 16 bytes each in the same order.
+# Users whose UUID isn't a canonical lowercase UUID travel as-is in 'loose'.
+SNAPSHOT_MAGIC = b'VSNP'
+SNAPSHOT_MIMETYPE = 'application/x-vpnsub-snapshot'
+SNAPSHOT_HEADER = struct.Struct('<BIII')
+CANONICAL_UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+def pack_snapshot(snapshot):
+    """Encode a full sync snapshot in the compact binary format"""
+    names = []
+    packed = []
+    loose = {}
+    for name, uuid in snapshot['users'].items():
+        # Anything else, including non-string values, travels as plain JSON
+        if isinstance(uuid, str) and CANONICAL_UUID.fullmatch(uuid) and '\0' not in name:
+            names.append(name)
+            packed.append(uuid)
+        else:
+            loose[name] = uuid
+    header = {key: value for key, value in snapshot.items() if key != 'users'}
+    header['count'] = len(names)
+    header['loose'] = loose
+    header = json.dumps(header, separators=(',', ':')).encode()
+    name_table = '\0'.join(names).encode()
+    uuid_table = bytes.fromhex(''.join(packed).replace('-', ''))
+    return b''.join([
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_HEADER.pack(1, len(header), len(name_table), len(uuid_table)),
+        header, name_table, uuid_table
+    ])
+
+# Character positions of a canonical UUID that come from hex digits, in order
+UUID_HEX_POSITIONS = [pos for pos in range(36) if pos not in (8, 13, 18, 23)]
+
+def format_uuids(packed):
+    """Canonical UUID strings for 16-byte packed UUIDs
+
+    Formatting each UUID in Python costs more than parsing the same
+    users as JSON. Instead every character position of all the UUIDs is
+    filled with one strided slice assignment into a buffer of 37-byte
+    records (36 characters plus a NUL), which one split() then cuts up.
+    """
+    count = len(packed) // 16
+    if len(packed) != count * 16:
+        raise ValueError("Corrupt snapshot")
+    digits = packed.hex().encode()
+    out = bytearray(37 * count)
+    for pos in (8, 13, 18, 23):
+        out[pos::37] = b'-' * count
+    for index, pos in enumerate(UUID_HEX_POSITIONS):
+        out[pos::37] = digits[index::32]
+    out[36::37] = b'\0' * count
+    return out.decode('ascii').split('\0')[:-1]
+
+def unpack_snapshot(data):
+    """Decode a binary snapshot straight into a sync payload dict"""
+    if data[:4] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a snapshot")
+    version, header_len, names_len, uuids_len = SNAPSHOT_HEADER.unpack_from(data, 4)
+    if version != 1:
+        raise ValueError(f"Unsupported snapshot version {version}")
+    offset = 4 + SNAPSHOT_HEADER.size
+    snapshot = json.loads(data[offset:offset + header_len])
+    offset += header_len
+    count = snapshot.pop('count')
+    names = data[offset:offset + names_len].decode().split('\0') if count else []
+    offset += names_len
+    uuids = format_uuids(data[offset:offset + uuids_len])
+    if len(names) != count or len(uuids) != count:
+        raise ValueError("Corrupt snapshot")
+    users = dict(zip(names, uuids))
+    users.update(snapshot.pop('loose'))
+    snapshot['users'] = users
+    return snapshot
+
+def content_version(data):
+    """Stable content hash for data that did not come from a file"""
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+class UserTable:
+    """Immutable username -> UUID map that is cheap to derive changed copies of
+
+    A table is a shared base dict plus a small overlay of recent changes
+    (None marks a deletion). with_changes() copies only the overlay, and
+    folds it into a new base once it grows past a fraction of the base,
+    so a single change costs O(overlay) rather than O(users). Neither dict
+    is modified after the table is built.
+    """
+
+    __slots__ = ('base', 'recent', 'count')
+
+    FOLD_MIN = 1024
+    FOLD_RATIO = 16
+
+    def __init__(self, base, recent=None, count=None):
+        self.base = base
+        self.recent = recent or {}
+        self.count = len(base) if count is None else count
+
+    def get(self, username, default=None):
+        recent = self.recent
+        if username in recent:
+            uuid = recent[username]
+            return default if uuid is None else uuid
+        return self.base.get(username, default)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (username for username, _ in self.items())
+
+    def items(self):
+        """(username, uuid) pairs; base order, then users changed since the last fold"""
+        if not self.recent:
+            return self.base.items()
+        return self._merged_items()
+
+    def _merged_items(self):
+        recent = self.recent
+        for username, uuid in self.base.items():
+            if username not in recent:
+                yield username, uuid
+        for username, uuid in recent.items():
+            if uuid is not None:
+                yield username, uuid
+
+    def to_dict(self):
+        """Plain dict for serialisation (may be the shared base; treat as read-only)"""
+        return self.base if not self.recent else dict(self._merged_items())
+
+    def with_changes(self, changes):
+        """New table with {username: uuid, or None to delete} applied"""
+        recent = dict(self.recent)
+        count = self.count
+        for username, uuid in changes.items():
+            old = recent[username] if username in recent else self.base.get(username)
+            count += (uuid is not None) - (old is not None)
+            if self.base.get(username) == uuid:
+                # Back to what the base says, nothing to overlay
+                recent.pop(username, None)
+            else:
+                recent[username] = uuid
+        if len(recent) > max(UserTable.FOLD_MIN, len(self.base) // UserTable.FOLD_RATIO):
+            base = dict(self.base)
+            for username, uuid in recent.items():
+                if uuid is None:
+                    base.pop(username, None)
+                else:
+                    base[username] = uuid
+            return UserTable(base)
+        return UserTable(self.base, recent, count)
+
+class NodeRecord:
+    """One node from nodes.json with its ranking inputs and links precomputed"""
+
+    __slots__ = ('name', 'region', 'weight', 'healthy', 'hash_key', 'templates', 'data')
+
+    def __init__(self, node):
+        self.data = node
+        self.name = node['name']
+        self.region = node.get('region')
+        load_ratio = NodeRecord.load_ratio(node)
+        if load_ratio is not None:
+            self.weight = node['capacity'] * max(1.0 - load_ratio, 0.05)
+        else:
+            self.weight = 1.0
+        self.healthy = node.get('healthy') is not False
+        self.hash_key = f"\0{self.name}".encode()
+        self.templates = LinkBuilder.compile(node)
+
+    @staticmethod
+    def load_ratio(node):
+        """load / capacity quantised to tenths, or None without a capacity
+
+        Quantised so small load changes don't reshuffle users. load is the
+        node's reported active users, filled in by NodeManager.record_load.
+        """
+        capacity = node.get('capacity') or 0
+        if capacity <= 0:
+            return None
+        return round(min(node.get('load', 0) / capacity, 1.0), 1)
+
+class Snapshot:
+    """Users and nodes as of one revision, never modified once published
+
+    Writers build a new snapshot under SYNC_LOCK and publish it by
+    rebinding Snapshot.current. A request reads that reference once and
+    sees users, nodes and revision that belong together, without locks.
+    Node records are carried over from the previous snapshot while
+    nodes.json is unchanged, so user changes don't recompile links.
+    """
+
+    __slots__ = ('users', 'nodes', 'records', 'nodes_version', 'epoch', 'revision', 'synced_at')
+
+    FIELDS = ('users', 'nodes', 'nodes_version', 'epoch', 'revision', 'synced_at')
+
+    def __init__(self, users, nodes, nodes_version, epoch, revision, synced_at, previous=None):
+        self.users = users
+        self.nodes = tuple(nodes)
+        self.nodes_version = nodes_version
+        self.epoch = epoch
+        self.revision = revision
+        self.synced_at = synced_at
+        if previous is not None and previous.nodes_version == nodes_version:
+            self.records = previous.records
+        else:
+            self.records = tuple(NodeRecord(node) for node in self.nodes)
+
+    def replace(self, **changes):
+        """Copy with some fields changed"""
+        fields = {name: getattr(self, name) for name in Snapshot.FIELDS}
+        fields.update(changes)
+        return Snapshot(previous=self, **fields)
+
+    @staticmethod
+    def publish(snapshot):
+        """Make snapshot the one requests see (caller holds SYNC_LOCK)"""
+        Snapshot.current = snapshot
+
+Snapshot.current = Snapshot(UserTable({}), (), '', None, 0, 0)
+
+class Metrics:
+    """In-process counters and histograms rendered in Prometheus text format
+
+    Histograms keep per-bucket counts and only accumulate them on render,
+    so recording an observation is one bisect and a few dict updates.
+    Metrics are per process; with several gunicorn workers each scrape
+    sees the worker that answered it.
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    # name -> (type, help, buckets)
+    DEFINITIONS = {
+        'vpnsub_requests_total': ('counter', 'HTTP requests by route, method and status', None),
+        'vpnsub_request_duration_seconds': ('histogram', 'HTTP request latency by route', LATENCY_BUCKETS),
+        'vpnsub_response_bytes': ('histogram', 'HTTP response body size by route', SIZE_BUCKETS),
+        'vpnsub_user_cache_total': ('counter', 'User lookups by cache outcome (hit, stale, miss)', None),
+        'vpnsub_render_cache_total': ('counter', 'Subscription body lookups by render cache outcome', None),
+        'vpnsub_sync_total': ('counter', 'Syncs from the master by result', None),
+        'vpnsub_sync_duration_seconds': ('histogram', 'Duration of syncs from the master by kind', LATENCY_BUCKETS),
+        'vpnsub_sync_payload_bytes': ('histogram', 'Size of sync responses received from the master', SIZE_BUCKETS),
+        'vpnsub_rate_limited_total': ('counter', 'Subscription requests refused with 429 by limit scope', None),
+        'vpnsub_negative_cache_total': ('counter', 'Unknown-user lookups answered from the negative cache', None),
+        'vpnsub_export_files_total': ('counter', 'Static subscription exports written or removed, per user', None),
+        'vpnsub_sync_connections_total': ('counter', 'Requests to the master by whether a pooled connection was reused', None),
+        'vpnsub_sync_connect_seconds': ('histogram', 'TCP connect plus TLS handshake time of new connections to the master', LATENCY_BUCKETS),
+        'vpnsub_sync_transfer_seconds': ('histogram', 'Request time to the master excluding connection setup', LATENCY_BUCKETS),
+        'vpnsub_token_verify_total': ('counter', 'Inter-node token checks by outcome (cached, verified, rejected)', None),
+        'vpnsub_warm_snapshot_total': ('counter', 'Local warm-start snapshots saved or loaded, and rejected ones by reason', None),
+        'vpnsub_file_reloads_total': ('counter', 'Edits of nodes.json or users.json picked up by the master', None),
+        'vpnsub_long_polls_total': ('counter', 'Long-poll sync requests held, or refused at the LONG_POLL_WAITERS limit, by requesting node', None),
+        'vpnsub_long_polls_refused_total': ('counter', 'Long-polls the sync source answered at once, leaving this node polling instead of pushed', None),
+    }
+
+    lock = threading.Lock()
+    counters = {}
+    # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+    histograms = {}
+
+    @staticmethod
+    def inc(name, labels=(), value=1):
+        """Increment a counter; labels is a tuple of (key, value) pairs"""
+        key = (name, labels)
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, value, labels=()):
+        """Record a histogram observation"""
+        buckets = Metrics.DEFINITIONS[name][2]
+        key = (name, labels)
+        with Metrics.lock:
+            counts = Metrics.histograms.get(key)
+            if counts is None:
+                counts = Metrics.histograms[key] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def counter_value(name, **match):
+        """Sum a counter over all label sets matching the given labels"""
+        with Metrics.lock:
+            items = list(Metrics.counters.items())
+        return sum(
+            value for (metric, labels), value in items
+            if metric == name and all(pair in labels for pair in match.items())
+        )
+
+    @staticmethod
+    def format_labels(labels):
+        """Render a label tuple as {key="value",...}"""
+        if not labels:
+            return ''
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+
+    @staticmethod
+    def render(gauges):
+        """Prometheus exposition text; gauges is {name: (help, [(labels, value)])}"""
+        with Metrics.lock:
+            counters = list(Metrics.counters.items())
+            histograms = [(key, list(counts)) for key, counts in Metrics.histograms.items()]
+
+        lines = []
+        for name, (kind, help_text, buckets) in Metrics.DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (metric, labels), value in counters:
+                    if metric == name:
+                        lines.append(f"{name}{Metrics.format_labels(labels)} {value}")
+                continue
+            for (metric, labels), counts in histograms:
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{Metrics.format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{Metrics.format_labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{Metrics.format_labels(labels)} {cumulative}")
+
+        for name, (help_text, samples) in gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{Metrics.format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count every request by route and record its latency and size"""
+    start = g.get('request_start')
+    if start is not None:
+        # Use the route pattern, not the path, to keep label cardinality bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (('route', route),)
+        Metrics.inc('vpnsub_requests_total', labels + (('method', request.method), ('status', response.status_code)))
+        Metrics.observe('vpnsub_request_duration_seconds', time.perf_counter() - start, labels)
+        if response.content_length is not None:
+            Metrics.observe('vpnsub_response_bytes', response.content_length, labels)
+    return response
+
+class ChangeLog:
+    """Bounded, revision-numbered log of user and node changes on the master
+
+    Each change gets the next revision number. Clients pass the last
+    revision they applied and receive only the newer changes, collapsed to
+    the latest value per key. Every master process mints its own epoch in
+    start_node() (a forked gunicorn worker would otherwise inherit the
+    arbiter's), so clients holding revisions from an earlier process fall
+    back to a full snapshot, as do clients whose revision has already been
+    evicted.
+
+    Replicas mirror the master's log instead of numbering their own
+    changes: they adopt its epoch and record each delta at the master's
+    revision, so clients can fail over between master and replicas and
+    keep syncing with deltas.
+    """
+
+    def __init__(self, size):
+        self.epoch = os.urandom(6).hex()
+        self.revision = 0
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Long-polls currently held in wait()
+        self.waiters = 0
+
+    def restart(self):
+        """Begin a new epoch at revision 0, as a freshly started master"""
+        self.reset(os.urandom(6).hex(), 0)
+
+    def record(self, kind, key, value):
+        """Append a change; value None means the key was removed"""
+        with self.lock:
+            self.revision += 1
+            self.entries.append((self.revision, kind, key, value))
+            self.changed.notify_all()
+            return self.revision
+
+    def reset(self, epoch, revision):
+        """Restart mirroring from an upstream full snapshot at revision"""
+        with self.lock:
+            self.epoch = epoch
+            self.revision = revision
+            self.entries.clear()
+            self.changed.notify_all()
+
+    def mirror(self, revision, changes):
+        """Record (kind, key, value) changes an upstream log made up to revision"""
+        with self.lock:
+            for kind, key, value in changes:
+                self.entries.append((revision, kind, key, value))
+            self.revision = max(self.revision, revision)
+            self.changed.notify_all()
+
+    def wait(self, epoch, revision, timeout):
+        """Block until a change newer than revision exists or timeout passes
+
+        At most LONG_POLL_WAITERS requests wait at once; gunicorn_options
+        adds that many threads, so held long-polls never take the THREADS
+        that serve everything else. None means the limit was reached and
+        the caller should answer straight away.
+        """
+        with self.lock:
+            if self.waiters >= CONFIG['LONG_POLL_WAITERS']:
+                return None
+            self.waiters += 1
+            try:
+                return self.changed.wait_for(
+                    lambda: self.revision > revision or self.epoch != epoch, timeout
+                )
+            finally:
+                self.waiters -= 1
+
+    def since(self, epoch, revision):
+        """(current revision, {kind: {key: value}}) after a revision, or None if unavailable"""
+        with self.lock:
+            if epoch != self.epoch or revision > self.revision:
+                return None
+            oldest = self.entries[0][0] if self.entries else self.revision + 1
+            if revision < oldest - 1:
+                return None
+            changes = {'user': {}, 'node': {}}
+            for rev, kind, key, value in reversed(self.entries):
+                if rev <= revision:
+                    break
+                changes[kind].setdefault(key, value)
+            return self.revision, changes
+
+CHANGELOG = ChangeLog(CONFIG['CHANGELOG_SIZE'])
+
+# Users shipped with a fresh master before users.json exists
+DEFAULT_USERS = {
+    "testuser": "3b331a0b-fe16-4c0a-9e25-26ba0ac6f57b",
+    "ali": "aae97e4b-8509-4c9b-8f1c-8c5095e1497b"
 }
 
-# In-memory cache (use Redis in production)
-CACHE = {
-    'users': {},
-    'last_sync': 0,
-    'nodes': []
-}
+class UserStore:
+    """Memory-resident user index backed by users.json plus an append-only log
+
+    users.json is the compacted snapshot; every mutation is appended to
+    users.log as one JSON line and applied to the in-memory index, so
+    lookups and writes are O(1). Once the log grows past
+    COMPACT_THRESHOLD entries the snapshot is rewritten atomically and
+    the log truncated. Replaying the log is idempotent, so a crash between
+    the two steps is harmless. on_change(username, uuid_or_None) is called
+    under the store lock for every effective mutation.
+
+    The users themselves are an immutable UserTable, replaced on every
+    write, so the table can be published in a Snapshot as it is.
+    """
+
+    def __init__(self, data_dir, on_change=None):
+        self.snapshot_path = os.path.join(data_dir, 'users.json')
+        self.log_path = os.path.join(data_dir, 'users.log')
+        self.lock = threading.Lock()
+        self.on_change = on_change
+        self.table = UserTable({})
+        self.by_uuid = {}
+        self.log_entries = 0
+        # Stat signature of users.json as we last read or wrote it
+        self.signature = None
+        # Signature of an edit that failed to parse, so it is reported once
+        self.unreadable = None
+        self.load()
+
+    def load(self):
+        """Load the snapshot and replay the log on top of it"""
+        self.signature = file_signature(self.snapshot_path)
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                users = json.load(f)
+        except FileNotFoundError:
+            users = dict(DEFAULT_USERS)
+
+        self.log_entries = 0
+        try:
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash; everything after it is lost anyway
+                        break
+                    UserStore._replay(users, entry)
+                    self.log_entries += len(entry.get('entries', ())) or 1
+        except FileNotFoundError:
+            pass
+
+        self.table = UserTable(users)
+        self.by_uuid = {}
+        for username, uuid in users.items():
+            self.by_uuid.setdefault(uuid, set()).add(username)
+
+    @staticmethod
+    def _replay(users, entry):
+        """Apply one log entry to a plain dict of users"""
+        if entry['op'] == 'batch':
+            for sub_entry in entry['entries']:
+                UserStore._replay(users, sub_entry)
+        elif entry['op'] == 'set':
+            users[entry['user']] = entry['uuid']
+        elif entry['op'] == 'del':
+            users.pop(entry['user'], None)
+
+    def _unindex_uuid(self, username, uuid):
+        """Remove a username from the UUID index"""
+        names = self.by_uuid.get(uuid)
+        if names:
+            names.discard(username)
+            if not names:
+                del self.by_uuid[uuid]
+
+    def _apply(self, changes):
+        """Apply {username: uuid or None} to the table and the UUID index"""
+        for username, uuid in changes.items():
+            old_uuid = self.table.get(username)
+            if old_uuid is not None:
+                self._unindex_uuid(username, old_uuid)
+            if uuid is not None:
+                self.by_uuid.setdefault(uuid, set()).add(username)
+        self.table = self.table.with_changes(changes)
+
+    def _append(self, entries):
+        """Durably append entries to the log (caller holds self.lock)"""
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+        with open(self.log_path, 'a') as f:
+            # Also serialise against other processes sharing the data dir
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.log_entries += len(entries)
+
+    def get(self, username):
+        """Look up a user's UUID"""
+        return self.table.get(username)
+
+    def snapshot(self):
+        """The current user table; immutable, so safe to serialise while writes continue"""
+        return self.table
+
+    def reload_if_changed(self):
+        """Adopt an outside edit of users.json; returns the {username: uuid or None} it changed
+
+        The edited file is authoritative. Its difference from memory is
+        applied like a write, and the log is truncated: its entries predate
+        the edit, and replaying them later would undo it. A missing or
+        unparsable file keeps the current users.
+        """
+        with self.lock:
+            signature = file_signature(self.snapshot_path)
+            if signature is None or signature == self.signature:
+                return {}
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    users = json.load(f)
+                if not isinstance(users, dict):
+                    raise ValueError("not a JSON object")
+            except (OSError, ValueError) as e:
+                if signature != self.unreadable:
+                    self.unreadable = signature
+                    app.logger.error(f"Keeping the current users, users.json is unreadable: {e}")
+                return {}
+            old = self.table
+            changes = {username: uuid for username, uuid in users.items() if old.get(username) != uuid}
+            changes.update((username, None) for username in old if username not in users)
+            if changes:
+                self._apply(changes)
+                if self.on_change:
+                    for username, uuid in changes.items():
+                        self.on_change(username, uuid)
+            self._truncate_log()
+            self.signature = signature
+            return changes
+
+    def find_by_uuid(self, uuid):
+        """Return the usernames sharing a UUID"""
+        return sorted(self.by_uuid.get(uuid, ()))
+
+    def set(self, username, uuid):
+        """Add or update a user"""
+        return self.apply_batch([('set', username, uuid)])[0] != 'unchanged'
+
+    def delete(self, username):
+        """Remove a user"""
+        return self.apply_batch([('del', username, None)])[0] == 'deleted'
+
+    def apply_batch(self, operations):
+        """Apply ('set'|'del', username, uuid) operations as one transaction
+
+        All effective changes are appended as a single log line, so a torn
+        write drops the whole batch rather than part of it. Returns one
+        status per operation: created, updated, unchanged, deleted or
+        not_found.
+        """
+        with self.lock:
+            statuses = []
+            entries = []
+            # Values as of earlier operations in this batch
+            pending = {}
+            for op, username, uuid in operations:
+                current = pending[username] if username in pending else self.table.get(username)
+                if op == 'set':
+                    if current == uuid:
+                        statuses.append('unchanged')
+                        continue
+                    statuses.append('created' if current is None else 'updated')
+                    entries.append({'op': 'set', 'user': username, 'uuid': uuid})
+                    pending[username] = uuid
+                else:
+                    if current is None:
+                        statuses.append('not_found')
+                        continue
+                    statuses.append('deleted')
+                    entries.append({'op': 'del', 'user': username})
+                    pending[username] = None
+
+            if entries:
+                self._append([entries[0] if len(entries) == 1 else {'op': 'batch', 'entries': entries}])
+                self.log_entries += len(entries) - 1
+                self._apply(pending)
+                if self.on_change:
+                    for entry in entries:
+                        self.on_change(entry['user'], entry.get('uuid'))
+                self._maybe_compact()
+            return statuses
+
+    def _maybe_compact(self):
+        """Compact once the log passes the configured threshold"""
+        if self.log_entries >= CONFIG['COMPACT_THRESHOLD']:
+            self._compact()
+
+    def compact(self):
+        """Rewrite the snapshot from memory and truncate the log"""
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        write_json_atomic(self.snapshot_path, self.table.to_dict())
+        # Our own write, not an edit for the file watcher to reload
+        self.signature = file_signature(self.snapshot_path)
+        self._truncate_log()
+
+    def _truncate_log(self):
+        """Empty the log once users.json holds everything in it (caller holds self.lock)"""
+        with open(self.log_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.truncate(0)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.log_entries = 0
+
+USER_STORE = {'store': None, 'lock': threading.Lock()}
+
+def backoff_delay(failures):
+    """Exponential backoff with jitter, capped at SYNC_BACKOFF_MAX"""
+    delay = min(CONFIG['SYNC_BACKOFF_MAX'], 2 ** failures)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class BackgroundRefresher:
+    """Single-flight background refresh of the client cache
+
+    Request handlers call trigger() when the cache is stale and carry on
+    serving the last good snapshot. At most one refresh runs at a time,
+    and after failures further attempts are held off with exponential
+    backoff so an unreachable master isn't hammered.
+    """
+
+    lock = threading.Lock()
+    in_flight = False
+    failures = 0
+    next_attempt = 0
+    done = threading.Event()
+
+    @staticmethod
+    def trigger():
+        """Start a refresh unless one is running or we are backing off"""
+        cls = BackgroundRefresher
+        with cls.lock:
+            if cls.in_flight or time.time() < cls.next_attempt:
+                return False
+            cls.in_flight = True
+            cls.done.clear()
+        threading.Thread(target=cls.run, name='cache-refresh', daemon=True).start()
+        return True
+
+    @staticmethod
+    def run():
+        """Perform one refresh and schedule the next allowed attempt"""
+        cls = BackgroundRefresher
+        success = False
+        try:
+            success = UserManager.sync_from_master()
+        finally:
+            with cls.lock:
+                if success:
+                    cls.failures = 0
+                    cls.next_attempt = 0
+                else:
+                    cls.failures += 1
+                    cls.next_attempt = time.time() + backoff_delay(cls.failures)
+                cls.in_flight = False
+                cls.done.set()
+
+    @staticmethod
+    def wait(timeout):
+        """Wait for the in-flight refresh, if any, to finish"""
+        if BackgroundRefresher.in_flight:
+            BackgroundRefresher.done.wait(timeout)
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    """Records how long opening each connection takes"""
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        SyncClient.record_connect(time.perf_counter() - start)
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    """Records how long the TCP connect plus TLS handshake takes"""
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        SyncClient.record_connect(time.perf_counter() - start)
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedAdapter(requests.adapters.HTTPAdapter):
+    """requests adapter whose pooled connections report their setup time"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+class SyncClient:
+    """Pooled keep-alive connections and reused tokens for node-to-node calls
+
+    Every call to the master (syncs, long-polls, stats reports) goes
+    through one client per process, so TCP and TLS handshakes happen once
+    per connection instead of once per request. With httpx and h2
+    installed the client speaks HTTP/2 where the other side offers it;
+    otherwise it pools HTTP/1.1 connections through requests. Each call
+    records connect time (zero when a pooled connection was reused)
+    separately from transfer time.
+    """
+
+    client = None
+    lock = threading.Lock()
+    timing = threading.local()
+    # Our current token and when it expires
+    token_state = {'token': None, 'expires': 0}
+
+    @staticmethod
+    def session():
+        """The process-wide HTTP client, created on first use (after any fork)"""
+        if SyncClient.client is None:
+            with SyncClient.lock:
+                if SyncClient.client is None:
+                    if httpx is not None and CONFIG['SYNC_HTTP2']:
+                        SyncClient.client = httpx.Client(
+                            http2=True,
+                            limits=httpx.Limits(max_connections=CONFIG['SYNC_POOL_SIZE'], keepalive_expiry=CONFIG['KEEPALIVE'])
+                        )
+                    else:
+                        session = requests.Session()
+                        adapter = TimedAdapter(pool_connections=4, pool_maxsize=CONFIG['SYNC_POOL_SIZE'])
+                        session.mount('http://', adapter)
+                        session.mount('https://', adapter)
+                        SyncClient.client = session
+        return SyncClient.client
+
+    @staticmethod
+    def record_connect(seconds):
+        SyncClient.timing.connect = getattr(SyncClient.timing, 'connect', 0.0) + seconds
+
+    @staticmethod
+    def trace(event, info):
+        """httpx trace hook: time from TCP connect start to the end of the TLS handshake"""
+        if event == 'connection.connect_tcp.started':
+            SyncClient.timing.started = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            SyncClient.timing.connect = time.perf_counter() - SyncClient.timing.started
+
+    @staticmethod
+    def token():
+        """Our JWT, minted again only when it is close to expiring"""
+        state = SyncClient.token_state
+        now = time.time()
+        if now >= state['expires'] - CONFIG['TOKEN_REFRESH_MARGIN']:
+            with SyncClient.lock:
+                if now >= state['expires'] - CONFIG['TOKEN_REFRESH_MARGIN']:
+                    state['token'] = UserManager.generate_token()
+                    state['expires'] = now + CONFIG['TOKEN_TTL']
+        return state['token']
+
+    @staticmethod
+    def request(method, path, endpoint, **kwargs):
+        """Authenticated request to the current sync source, with connect/transfer timing"""
+        headers = dict(kwargs.pop('headers', {}), Authorization=f"Bearer {SyncClient.token()}")
+        url = f"{UserManager.sync_source()}{path}"
+        SyncClient.timing.connect = 0.0
+        client = SyncClient.session()
+        start = time.perf_counter()
+        if httpx is not None and isinstance(client, httpx.Client):
+            response = client.request(method, url, headers=headers, extensions={'trace': SyncClient.trace}, **kwargs)
+        else:
+            response = client.request(method, url, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - start
+        connect = SyncClient.timing.connect
+        labels = (('endpoint', endpoint),)
+        Metrics.inc('vpnsub_sync_connections_total', labels + (('reused', 'false' if connect else 'true'),))
+        if connect:
+            Metrics.observe('vpnsub_sync_connect_seconds', connect, labels)
+        Metrics.observe('vpnsub_sync_transfer_seconds', max(elapsed - connect, 0.0), labels)
+        return response
+
+class UserManager:
+    """Manages user data with caching and sync"""
+    
+    @staticmethod
+    def current():
+        """The snapshot to serve from; read it once per request"""
+        if CONFIG['NODE_TYPE'] == 'master':
+            # Master node: published by the user store on every write
+            Metrics.inc('vpnsub_user_cache_total', (('result', 'hit'),))
+            UserManager.store()
+        else:
+            # Client node: serve the cached snapshot, refreshing it in the background
+            if not UserManager.cache_expired():
+                Metrics.inc('vpnsub_user_cache_total', (('result', 'hit'),))
+            elif Snapshot.current.synced_at:
+                Metrics.inc('vpnsub_user_cache_total', (('result', 'stale'),))
+                BackgroundRefresher.trigger()
+            else:
+                Metrics.inc('vpnsub_user_cache_total', (('result', 'miss'),))
+                BackgroundRefresher.trigger()
+                # Nothing to serve yet; wait briefly for the in-flight sync
+                BackgroundRefresher.wait(5)
+        return Snapshot.current
+    
+    @staticmethod
+    def get_users():
+        """Get users with cache (a read-only UserTable)"""
+        return UserManager.current().users
+    
+    @staticmethod
+    def cache_expired():
+        """Check if cache needs refresh"""
+        return time.time() > CACHE['refresh_at']
+    
+    @staticmethod
+    def sync_from_master(wait=0):
+        """Sync users from master node, applying deltas when possible
+
+        With wait > 0 the master holds the request open until it has a
+        change newer than our revision, turning the call into a long-poll.
+        """
+        current = Snapshot.current
+        kind = 'longpoll' if wait and current.epoch else 'poll'
+        start = time.perf_counter()
+        try:
+            headers = {'X-Node-Name': CONFIG['NODE_NAME']}
+            if CONFIG['SYNC_BINARY']:
+                headers['Accept'] = f"{SNAPSHOT_MIMETYPE}, application/json;q=0.9"
+            params = {}
+            if current.epoch:
+                params = {'since': current.revision, 'epoch': current.epoch}
+                if wait:
+                    params['wait'] = wait
+            source = UserManager.sync_source()
+            response = SyncClient.request('GET', '/api/v1/sync', 'sync', headers=headers, params=params, timeout=5 + wait)
+            
+            if response.status_code == 200:
+                if response.headers.get('Content-Type', '').startswith(SNAPSHOT_MIMETYPE):
+                    data = unpack_snapshot(response.content)
+                else:
+                    data = response.json()
+                if data.get('mode') != 'delta' and not data.get('epoch'):
+                    # A source with nothing to give; publishing it would drop every user
+                    raise ValueError("full snapshot without an epoch")
+                with SYNC_LOCK:
+                    UserManager.apply_sync(data)
+                try:
+                    WarmStart.save_if_due()
+                except Exception as e:
+                    # The sync itself succeeded; only the local copy is missing
+                    app.logger.warning(f"Warm-start snapshot not saved: {e}")
+                    Metrics.inc('vpnsub_warm_snapshot_total', (('result', 'error'),))
+                Metrics.inc('vpnsub_sync_total', (('result', 'ok'), ('mode', data.get('mode', 'full'))))
+                Metrics.observe('vpnsub_sync_duration_seconds', time.perf_counter() - start, (('kind', kind),))
+                # Bytes on the wire, i.e. after compression when the master compressed
+                Metrics.observe('vpnsub_sync_payload_bytes', int(response.headers.get('Content-Length', len(response.content))))
+                return True
+            app.logger.error(f"Sync from {source} failed: HTTP {response.status_code}")
+        except Exception as e:
+            app.logger.error(f"Sync failed: {e}")
+        Metrics.inc('vpnsub_sync_total', (('result', 'error'),))
+        UserManager.fail_over()
+        return False
+    
+    @staticmethod
+    def sync_source():
+        """Master or replica URL to sync from"""
+        sources = [url.strip().rstrip('/') for url in CONFIG['MASTER_API'].split(',') if url.strip()]
+        return sources[CACHE['source_index'] % len(sources)]
+    
+    @staticmethod
+    def fail_over():
+        """Move on to the next MASTER_API entry after a failed sync"""
+        if ',' in CONFIG['MASTER_API']:
+            CACHE['source_index'] += 1
+    
+    @staticmethod
+    def apply_sync(data, synced_at=None):
+        """Publish the snapshot a sync response leads to (caller holds SYNC_LOCK)"""
+        current = Snapshot.current
+        if data.get('epoch') == current.epoch and data.get('revision', 0) < current.revision:
+            # A concurrent sync already applied something newer
+            return
+        now = time.time()
+        fields = {'epoch': data.get('epoch'), 'revision': data.get('revision', 0), 'synced_at': synced_at or now}
+        if data.get('mode') == 'delta':
+            fields.update(UserManager.apply_delta(current, data))
+        else:
+            nodes = data.get('nodes', [])
+            fields.update(users=UserTable(data.get('users', {})), nodes=nodes, nodes_version=content_version(nodes))
+        if CONFIG['NODE_TYPE'] == 'replica':
+            UserManager.mirror_changes(data)
+        Snapshot.publish(current.replace(**fields))
+        # Jitter the next refresh so client nodes don't hit the master in lockstep
+        CACHE['refresh_at'] = now + CONFIG['CACHE_TTL'] * random.uniform(0.8, 1.0)
+    
+    @staticmethod
+    def mirror_changes(data):
+        """Replicas: copy an upstream sync response into our own change log"""
+        if data.get('mode') != 'delta':
+            CHANGELOG.reset(data.get('epoch'), data.get('revision', 0))
+            return
+        users = data['users']
+        nodes = data['nodes']
+        changes = [('user', name, uuid) for name, uuid in users['set'].items()]
+        changes += [('user', name, None) for name in users['deleted']]
+        changes += [('node', node['name'], node) for node in nodes['set']]
+        changes += [('node', name, None) for name in nodes['deleted']]
+        if nodes.get('order'):
+            changes.append(('node', None, nodes['order']))
+        CHANGELOG.mirror(data.get('revision', 0), changes)
+    
+    @staticmethod
+    def promote():
+        """Turn this replica into the master, keeping its epoch and revision
+
+        The replicated users and nodes become the master's files, so
+        clients and other replicas that fail over to us carry on with
+        deltas. Make sure the old master is really gone first: two masters
+        would accept conflicting writes.
+        """
+        with SYNC_LOCK:
+            current = Snapshot.current
+            write_json_atomic(os.path.join(CONFIG['DATA_DIR'], 'users.json'), current.users.to_dict())
+            write_json_atomic(os.path.join(CONFIG['DATA_DIR'], 'nodes.json'), list(current.nodes))
+            # Leftover log entries from an earlier life would replay over the new snapshot
+            open(os.path.join(CONFIG['DATA_DIR'], 'users.log'), 'w').close()
+            CONFIG['NODE_TYPE'] = 'master'
+        UserManager.store()
+        FileWatcher.start()
+        app.logger.info(f"Promoted to master at revision {CHANGELOG.revision}")
+    
+    @staticmethod
+    def feed_path():
+        return os.path.join(CONFIG['DATA_DIR'], 'change-feed.rev')
+
+    @staticmethod
+    def feed_leader():
+        """True if this process runs the host's long-poll"""
+        try:
+            return host_lock('change-feed')
+        except OSError:
+            # No usable DATA_DIR to coordinate through; follow the master ourselves
+            return True
+
+    @staticmethod
+    def follow_master():
+        """Keep this process within a second of the master (stops on promotion)
+
+        One process per host long-polls the master and rewrites
+        DATA_DIR/change-feed.rev whenever that brings a new revision. The
+        other gunicorn workers watch that file and catch up with a quick
+        delta sync, so the master holds one request per host rather than
+        one per worker. If the long-polling worker dies another takes over.
+        """
+        failures = 0
+        seen = None
+        refused = False
+        while CONFIG['NODE_TYPE'] != 'master':
+            before = Snapshot.current
+            if UserManager.feed_leader():
+                start = time.monotonic()
+                ok = UserManager.sync_from_master(wait=CONFIG['LONG_POLL_TIMEOUT'])
+                current = Snapshot.current
+                if ok and (current.epoch, current.revision) != (before.epoch, before.revision):
+                    refused = False
+                    try:
+                        write_file_atomic(UserManager.feed_path(), f"{current.epoch} {current.revision}\n".encode())
+                    except OSError as e:
+                        app.logger.warning(f"Could not signal other workers: {e}")
+                elif ok and time.monotonic() - start < 1:
+                    # Answered at once with no news: the master is at its long-poll limit
+                    Metrics.inc('vpnsub_long_polls_refused_total')
+                    if not refused:
+                        app.logger.warning(
+                            f"{UserManager.sync_source()} refused our long-poll (LONG_POLL_WAITERS reached); "
+                            "polling every few seconds until it accepts one"
+                        )
+                    refused = True
+                    time.sleep(random.uniform(0.5, 1.0) * min(CONFIG['LONG_POLL_TIMEOUT'], 10))
+                elif ok:
+                    # Held until it timed out: push is working
+                    refused = False
+            else:
+                signature = file_signature(UserManager.feed_path())
+                if signature == seen:
+                    time.sleep(CONFIG['FEED_CHECK_INTERVAL'])
+                    continue
+                ok = UserManager.sync_from_master()
+                if ok:
+                    seen = signature
+            if ok:
+                failures = 0
+            else:
+                failures += 1
+                time.sleep(backoff_delay(failures))
+    
+    @staticmethod
+    def start_change_feed():
+        """Run follow_master in a daemon thread"""
+        thread = threading.Thread(target=UserManager.follow_master, name='change-feed', daemon=True)
+        thread.start()
+        return thread
+    
+    @staticmethod
+    def apply_delta(current, data):
+        """Snapshot fields that change when a delta sync response is applied to current"""
+        changes = dict(data['users']['set'])
+        changes.update((username, None) for username in data['users']['deleted'])
+        fields = {'users': current.users.with_changes(changes) if changes else current.users}
+
+        node_delta = data['nodes']
+        if node_delta['set'] or node_delta['deleted'] or node_delta.get('order'):
+            by_name = {node['name']: node for node in current.nodes}
+            for node in node_delta['set']:
+                by_name[node['name']] = node
+            for name in node_delta['deleted']:
+                by_name.pop(name, None)
+            order = node_delta.get('order') or list(by_name)
+            fields['nodes'] = [by_name[name] for name in order if name in by_name]
+            fields['nodes_version'] = content_version(fields['nodes'])
+        return fields
+    
+    @staticmethod
+    def store():
+        """Open the master's user store on first use and publish its first snapshot"""
+        if USER_STORE['store'] is None:
+            with USER_STORE['lock']:
+                if USER_STORE['store'] is None:
+                    store = UserStore(
+                        CONFIG['DATA_DIR'],
+                        on_change=lambda username, uuid: CHANGELOG.record('user', username, uuid)
+                    )
+                    with SYNC_LOCK:
+                        UserManager.publish_users(store)
+                    NodeManager.reload()
+                    USER_STORE['store'] = store
+        return USER_STORE['store']
+    
+    @staticmethod
+    def publish_users(store):
+        """Master: publish the store's users with the change-log revision that matches them (caller holds SYNC_LOCK)"""
+        Snapshot.publish(Snapshot.current.replace(
+            users=store.table, epoch=CHANGELOG.epoch, revision=CHANGELOG.revision, synced_at=time.time()
+        ))
+    
+    @staticmethod
+    def load_from_database():
+        """Return the master's in-memory user table"""
+        return UserManager.store().table
+    
+    @staticmethod
+    def snapshot_users():
+        """All users as a dict for serialisation (treat as read-only)"""
+        return UserManager.current().users.to_dict()
+    
+    @staticmethod
+    def save_user(username, uuid):
+        """Add or update a single user on the master"""
+        return UserManager.apply_batch([('set', username, uuid)])[0] != 'unchanged'
+    
+    @staticmethod
+    def apply_batch(operations):
+        """Apply many user upserts/deletes on the master in one transaction"""
+        store = UserManager.store()
+        # Held across the write so the published revision matches the users
+        with SYNC_LOCK:
+            statuses = store.apply_batch(operations)
+            if store.table is not Snapshot.current.users:
+                UserManager.publish_users(store)
+        return statuses
+    
+    @staticmethod
+    def reload_users():
+        """Master: pick up an outside edit of users.json"""
+        store = UserManager.store()
+        with SYNC_LOCK:
+            changes = store.reload_if_changed()
+            if changes:
+                UserManager.publish_users(store)
+        if changes:
+            app.logger.info(f"Reloaded users.json: {len(changes)} users changed")
+        return bool(changes)
+    
+    @staticmethod
+    def generate_token():
+        """Generate JWT token for inter-node communication"""
+        payload = {
+            'node': CONFIG['NODE_NAME'],
+            'exp': datetime.utcnow() + timedelta(seconds=CONFIG['TOKEN_TTL'])
+        }
+        return jwt.encode(payload, CONFIG['JWT_SECRET'], algorithm='HS256')
+    
+    # token -> expiry of tokens that already passed jwt.decode
+    verified_tokens = OrderedDict()
+    verified_lock = threading.Lock()
+
+    @staticmethod
+    def verify_token(token):
+        """Verify JWT token, skipping the signature check for recently verified ones"""
+        now = time.time()
+        with UserManager.verified_lock:
+            expires = UserManager.verified_tokens.get(token)
+            if expires is not None:
+                if expires > now:
+                    UserManager.verified_tokens.move_to_end(token)
+                    Metrics.inc('vpnsub_token_verify_total', (('result', 'cached'),))
+                    return True
+                del UserManager.verified_tokens[token]
+        try:
+            payload = jwt.decode(token, CONFIG['JWT_SECRET'], algorithms=['HS256'])
+        except Exception:
+            Metrics.inc('vpnsub_token_verify_total', (('result', 'rejected'),))
+            return False
+        Metrics.inc('vpnsub_token_verify_total', (('result', 'verified'),))
+        # Tokens without an expiry are only trusted from cache for a minute
+        expires = payload.get('exp', now + 60)
+        with UserManager.verified_lock:
+            UserManager.verified_tokens[token] = expires
+            if len(UserManager.verified_tokens) > CONFIG['TOKEN_CACHE_SIZE']:
+                UserManager.verified_tokens.popitem(last=False)
+        return True
+
+# Warm-start snapshot file (version 1):
+#   b'VWRM', struct '<BIdIII' (version, CRC32 of everything after the struct,
+#   saved_at, header length, names length, uuids length),
+#   JSON header (epoch, revision, nodes, plus 'count' and 'loose'),
+#   usernames joined by NUL, then UUIDs joined by NUL, both UTF-8.
+# Unlike the sync format, UUIDs stay as text: splitting one string is much
+# faster than formatting packed UUIDs, and load time is what matters here.
+WARM_MAGIC = b'VWRM'
+WARM_HEADER = struct.Struct('<BIdIII')
+
+class WarmStart:
+    """Local copy of the last synced snapshot, so a restarted node serves at once
+
+    After successful syncs one process per host writes the snapshot to
+    DATA_DIR/warm-snapshot.bin, at most every WARM_START_INTERVAL. On
+    startup the file is loaded before talking to the master; requests are
+    served from it while a background sync catches up, by delta when the
+    master still has our revision in its change log.
+    """
+
+    saved = {'key': None, 'at': 0}
+
+    @staticmethod
+    def path():
+        return os.path.join(CONFIG['DATA_DIR'], 'warm-snapshot.bin')
+
+    @staticmethod
+    def encode(users, nodes, epoch, revision, saved_at):
+        """Serialise a snapshot in the warm-start format"""
+        names = []
+        uuids = []
+        loose = {}
+        for name, uuid in users.items():
+            if '\0' in name or '\0' in uuid:
+                loose[name] = uuid
+            else:
+                names.append(name)
+                uuids.append(uuid)
+        header = json.dumps({
+            'epoch': epoch, 'revision': revision, 'nodes': nodes,
+            'count': len(names), 'loose': loose
+        }, separators=(',', ':')).encode()
+        name_table = '\0'.join(names).encode()
+        uuid_table = '\0'.join(uuids).encode()
+        body = header + name_table + uuid_table
+        return WARM_MAGIC + WARM_HEADER.pack(
+            1, zlib.crc32(body), saved_at, len(header), len(name_table), len(uuid_table)
+        ) + body
+
+    @staticmethod
+    def decode(data):
+        """Parse a warm-start file into (saved_at, sync payload dict)"""
+        if data[:4] != WARM_MAGIC:
+            raise ValueError("Not a warm-start snapshot")
+        version, checksum, saved_at, header_len, names_len, uuids_len = WARM_HEADER.unpack_from(data, 4)
+        if version != 1:
+            raise ValueError(f"Unsupported warm-start version {version}")
+        body = memoryview(data)[4 + WARM_HEADER.size:]
+        if len(body) != header_len + names_len + uuids_len or zlib.crc32(body) != checksum:
+            raise ValueError("Checksum mismatch")
+        snapshot = json.loads(bytes(body[:header_len]))
+        count = snapshot.pop('count')
+        users = {}
+        if count:
+            names = str(body[header_len:header_len + names_len], 'utf-8').split('\0')
+            uuids = str(body[header_len + names_len:], 'utf-8').split('\0')
+            if len(names) != count or len(uuids) != count:
+                raise ValueError("Corrupt snapshot")
+            users = dict(zip(names, uuids))
+        users.update(snapshot.pop('loose'))
+        snapshot['users'] = users
+        snapshot['mode'] = 'full'
+        return saved_at, snapshot
+
+    @staticmethod
+    def save_if_due():
+        """Write the current snapshot out if it changed and the last write is old enough"""
+        if not CONFIG['WARM_START'] or not host_lock('warm-start'):
+            return False
+        snapshot = Snapshot.current
+        key = (snapshot.epoch, snapshot.revision)
+        now = time.time()
+        if key == WarmStart.saved['key'] or now - WarmStart.saved['at'] < CONFIG['WARM_START_INTERVAL']:
+            return False
+        data = WarmStart.encode(snapshot.users, snapshot.nodes, snapshot.epoch, snapshot.revision, now)
+        write_file_atomic(WarmStart.path(), data)
+        WarmStart.saved.update(key=key, at=now)
+        Metrics.inc('vpnsub_warm_snapshot_total', (('result', 'saved'),))
+        return True
+
+    @staticmethod
+    def load():
+        """Publish the local snapshot; True if there is something to serve"""
+        if not CONFIG['WARM_START']:
+            return False
+        start = time.perf_counter()
+        try:
+            with open(WarmStart.path(), 'rb') as f:
+                saved_at, snapshot = WarmStart.decode(f.read())
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error) as e:
+            app.logger.warning(f"Ignoring warm-start snapshot: {e}")
+            Metrics.inc('vpnsub_warm_snapshot_total', (('result', 'corrupt'),))
+            return False
+        age = time.time() - saved_at
+        if CONFIG['WARM_START_MAX_AGE'] and age > CONFIG['WARM_START_MAX_AGE']:
+            app.logger.warning(f"Ignoring warm-start snapshot from {int(age)}s ago")
+            Metrics.inc('vpnsub_warm_snapshot_total', (('result', 'stale'),))
+            return False
+        with SYNC_LOCK:
+            # Report the snapshot's real age and refresh on the first request
+            UserManager.apply_sync(snapshot, synced_at=saved_at)
+            CACHE['refresh_at'] = 0
+        WarmStart.saved.update(key=(snapshot['epoch'], snapshot['revision']), at=saved_at)
+        Metrics.inc('vpnsub_warm_snapshot_total', (('result', 'loaded'),))
+        app.logger.info(
+            f"Warm start: {len(snapshot['users'])} users at revision {snapshot['revision']} "
+            f"from {int(age)}s ago, loaded in {(time.perf_counter() - start) * 1000:.0f}ms"
+        )
+        return True
+
+class NodeManager:
+    """Manages distributed nodes"""
+    
+    # Signature of a nodes.json that failed to parse, so it is reported once
+    unreadable = None
+    
+    @staticmethod
+    def get_all_nodes():
+        """Get all registered nodes"""
+        if CONFIG['NODE_TYPE'] == 'master':
+            UserManager.store()
+        return Snapshot.current.nodes
+    
+    @staticmethod
+    def load_nodes():
+        """Read nodes.json as (nodes, version); None if it is unreadable mid-edit"""
+        path = os.path.join(CONFIG['DATA_DIR'], 'nodes.json')
+        try:
+            return load_json_file(path)
+        except FileNotFoundError:
+            return [
+                {"name": "Finland", "host": "freedomacrossborders.shop", "port": 8443, "region": "EU"},
+                {"name": "Bahrain", "host": "154.205.146.39", "port": 8443, "region": "ME"}
+            ], 'default'
+        except (OSError, ValueError) as e:
+            signature = file_signature(path)
+            if signature != NodeManager.unreadable:
+                NodeManager.unreadable = signature
+                app.logger.error(f"Keeping the current nodes, nodes.json is unreadable: {e}")
+            return None
+    
+    @staticmethod
+    def reload():
+        """Master: publish nodes.json if it changed since the current snapshot"""
+        with SYNC_LOCK:
+            return NodeManager._reload()
+    
+    @staticmethod
+    def _reload():
+        """reload() for callers that already hold SYNC_LOCK"""
+        loaded = NodeManager.load_nodes()
+        current = Snapshot.current
+        if loaded is None or loaded[1] == current.nodes_version:
+            return False
+        nodes, version = loaded
+        NodeManager.record_changes(current.nodes, nodes)
+        Snapshot.publish(current.replace(
+            nodes=nodes, nodes_version=version, revision=CHANGELOG.revision, synced_at=time.time()
+        ))
+        return True
+    
+    @staticmethod
+    def record_changes(old_nodes, new_nodes):
+        """Record node additions, updates and removals in the change log"""
+        old = {node['name']: node for node in old_nodes}
+        new = {node['name']: node for node in new_nodes}
+        for name, node in new.items():
+            if old.get(name) != node:
+                CHANGELOG.record('node', name, node)
+        for name in old:
+            if name not in new:
+                CHANGELOG.record('node', name, None)
+        if list(old) != list(new):
+            # Reordering alone still has to reach clients
+            CHANGELOG.record('node', None, list(new))
+    
+    @staticmethod
+    def register_node(node_data):
+        """Register a new node"""
+        UserManager.store()
+        # Held from read to publish so concurrent registrations can't drop each other
+        with SYNC_LOCK:
+            # Start from any edit of nodes.json the watcher hasn't picked up yet
+            NodeManager._reload()
+            nodes = list(Snapshot.current.nodes)
+            # Update or add node
+            for i, node in enumerate(nodes):
+                if node['name'] == node_data['name']:
+                    nodes[i] = node_data
+                    break
+            else:
+                nodes.append(node_data)
+            NodeManager._save(nodes)
+        return True
+    
+    @staticmethod
+    def record_load(name, load):
+        """Master: store a node's reported load in nodes.json when it moves the node's weight
+
+        Only changes that cross a tenth of capacity are written, so clients
+        get a node delta (and users are re-ranked) only when it matters.
+        """
+        UserManager.store()
+        with SYNC_LOCK:
+            NodeManager._reload()
+            nodes = list(Snapshot.current.nodes)
+            for i, node in enumerate(nodes):
+                if node['name'] == name:
+                    break
+            else:
+                return False
+            updated = dict(node, load=load)
+            if NodeRecord.load_ratio(updated) in (None, NodeRecord.load_ratio(node)):
+                return False
+            nodes[i] = updated
+            NodeManager._save(nodes)
+        return True
+    
+    @staticmethod
+    def _save(nodes):
+        """Write nodes.json and publish it (caller holds SYNC_LOCK)"""
+        # Atomic, so the file watcher never reads a half-written file
+        write_json_atomic(os.path.join(CONFIG['DATA_DIR'], 'nodes.json'), nodes)
+        # Publish the new file now so the change log sees it immediately
+        NodeManager._reload()
+
+class FileWatcher:
+    """Hot-reloads nodes.json and users.json on the master when they are edited
+
+    Checks both files' stat signatures every WATCH_INTERVAL seconds and
+    publishes a new snapshot when one changed, so edits take effect
+    without a restart and requests never touch the disk. Changes go into
+    the change log like API writes, so clients get them as deltas.
+    Compaction rewrites of users.json are recognised and skipped.
+    """
+
+    thread = None
+
+    @staticmethod
+    def check():
+        """Reload whichever files changed; returns the names reloaded"""
+        # The store publishes the first snapshot; reloads only build on it
+        UserManager.store()
+        reloaded = []
+        if NodeManager.reload():
+            reloaded.append('nodes.json')
+        if UserManager.reload_users():
+            reloaded.append('users.json')
+        for name in reloaded:
+            Metrics.inc('vpnsub_file_reloads_total', (('file', name),))
+        return reloaded
+
+    @staticmethod
+    def run():
+        """Watch loop (stops if this node stops being the master)"""
+        while CONFIG['NODE_TYPE'] == 'master':
+            try:
+                FileWatcher.check()
+            except Exception as e:
+                app.logger.error(f"Reloading data files failed: {e}")
+            time.sleep(CONFIG['WATCH_INTERVAL'])
+
+    @staticmethod
+    def start():
+        """Run the watch loop in a daemon thread, once per process"""
+        if FileWatcher.thread is None and CONFIG['WATCH_INTERVAL'] > 0:
+            FileWatcher.thread = threading.Thread(target=FileWatcher.run, name='file-watcher', daemon=True)
+            FileWatcher.thread.start()
+        return FileWatcher.thread
+
+class GeoIP:
+    """Maps requester IPs to node regions using a local MaxMind database"""
+
+    reader = None
+    # country ISO code -> region, parsed from REGION_COUNTRIES
+    regions = {}
+
+    @staticmethod
+    def setup():
+        """Open the database once; GeoIP stays disabled if it is unavailable"""
+        for group in CONFIG['REGION_COUNTRIES'].split(';'):
+            if ':' in group:
+                region, countries = group.split(':', 1)
+                for country in countries.split(','):
+                    GeoIP.regions[country.strip().upper()] = region.strip()
+        if not CONFIG['GEOIP_DB']:
+            return
+        try:
+            import maxminddb
+            GeoIP.reader = maxminddb.open_database(CONFIG['GEOIP_DB'])
+        except Exception as e:
+            app.logger.error(f"GeoIP disabled: {e}")
+
+    @staticmethod
+    def region_for(ip):
+        """Region of an IP address, or None if unknown"""
+        if GeoIP.reader is None or not ip:
+            return None
+        try:
+            record = GeoIP.reader.get(ip) or {}
+        except ValueError:
+            return None
+        country = record.get('country', {}).get('iso_code')
+        return GeoIP.regions.get(country)
+
+GeoIP.setup()
+
+def requester_ip():
+    """Client address of the current request, or None if it isn't valid
+
+    X-Real-IP is only trusted from a loopback peer, i.e. nginx on this
+    host; anyone else could set it to dodge per-IP rate limits.
+    """
+    ip = request.remote_addr
+    forwarded = request.headers.get('X-Real-IP')
+    try:
+        if forwarded and ipaddress.ip_address(ip).is_loopback:
+            ip = forwarded
+        return str(ipaddress.ip_address(ip))
+    except (TypeError, ValueError):
+        return None
+
+def requester_region():
+    """Region of the current request: ?region= override, then GeoIP"""
+    region = request.args.get('region')
+    if region:
+        return region
+    return GeoIP.region_for(requester_ip())
+
+def users_version():
+    """(epoch, revision) of the user list this node is serving"""
+    snapshot = Snapshot.current
+    return snapshot.epoch, snapshot.revision
+
+class LocalBuckets:
+    """Token buckets in process memory, least recently used evicted first
+
+    An evicted bucket comes back full, which is what an idle bucket
+    would have refilled to anyway; under a flood of distinct keys the
+    oldest ones go first, so memory stays at max_entries per scope.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # key -> [tokens, last refill time]
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [float(burst), now]
+                if len(self.buckets) > self.max_entries:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+class RedisBuckets:
+    """Token buckets in Redis, shared by every worker and node using it
+
+    The refill-and-take runs as one Lua script, so concurrent workers
+    can't both spend the last token. Idle buckets expire once they would
+    have refilled.
+    """
+
+    SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.script = self.client.register_script(RedisBuckets.SCRIPT)
+
+    def take(self, key, rate, burst):
+        """Same contract as LocalBuckets.take; raises on Redis errors"""
+        allowed, tokens = self.script(keys=[f"vpnsub:rl:{key}"], args=[rate, burst, time.time()])
+        if int(allowed):
+            return 0
+        return (1 - float(tokens)) / rate
+
+class RateLimiter:
+    """Per-IP and per-user token buckets for /sub/<user>
+
+    Every request spends a token from its source IP's bucket; requests
+    for known users also spend one from the user's bucket, so scanning
+    usernames is capped per IP without letting unknown names fill the
+    user table. Buckets live in process memory unless RATE_LIMIT_REDIS is
+    set. If Redis becomes unreachable we fall back to the local buckets
+    rather than failing requests.
+    """
+
+    local = {}
+    redis = None
+    redis_error_at = 0
+
+    @staticmethod
+    def setup():
+        """Create the bucket stores; Redis stays off if it can't be used"""
+        RateLimiter.local = {
+            'ip': LocalBuckets(CONFIG['RATE_LIMIT_ENTRIES']),
+            'user': LocalBuckets(CONFIG['RATE_LIMIT_ENTRIES'])
+        }
+        if not CONFIG['RATE_LIMIT_REDIS']:
+            return
+        try:
+            RateLimiter.redis = RedisBuckets(CONFIG['RATE_LIMIT_REDIS'])
+        except Exception as e:
+            app.logger.error(f"Redis rate limiting disabled: {e}")
+
+    @staticmethod
+    def check(scope, key):
+        """Seconds the caller must wait, or 0 if the request may proceed"""
+        if not CONFIG['RATE_LIMIT'] or key is None:
+            return 0
+        per_min = CONFIG[f"RATE_LIMIT_{scope.upper()}_PER_MIN"]
+        burst = CONFIG[f"RATE_LIMIT_{scope.upper()}_BURST"]
+        if RateLimiter.redis is not None:
+            try:
+                return RateLimiter.redis.take(f"{scope}:{key}", per_min / 60, burst)
+            except Exception as e:
+                now = time.time()
+                if now - RateLimiter.redis_error_at > 60:
+                    RateLimiter.redis_error_at = now
+                    app.logger.error(f"Redis rate limiting failed, using local buckets: {e}")
+        return RateLimiter.local[scope].take(key, per_min / 60, burst)
+
+RateLimiter.setup()
+
+class NegativeCache:
+    """Recently requested unknown usernames, so repeat 404s skip the lookup
+
+    Entries are tied to the users_version they were looked up at and
+    dropped as soon as the user list changes, so a newly added user is
+    never refused. Bounded like LocalBuckets: oldest entries go first.
+    """
+
+    entries = OrderedDict()
+    lock = threading.Lock()
+
+    @staticmethod
+    def contains(user):
+        """True if user was unknown at the current user list version"""
+        with NegativeCache.lock:
+            entry = NegativeCache.entries.get(user)
+            if entry is None:
+                return False
+            version, expires = entry
+            if version != users_version() or time.monotonic() > expires:
+                del NegativeCache.entries[user]
+                return False
+            return True
+
+    @staticmethod
+    def add(user, version):
+        """Remember that user is unknown at users_version() == version"""
+        if CONFIG['NEGATIVE_CACHE_SIZE'] <= 0:
+            return
+        with NegativeCache.lock:
+            NegativeCache.entries[user] = (version, time.monotonic() + CONFIG['NEGATIVE_CACHE_TTL'])
+            NegativeCache.entries.move_to_end(user)
+            if len(NegativeCache.entries) > CONFIG['NEGATIVE_CACHE_SIZE']:
+                NegativeCache.entries.popitem(last=False)
+
+class NodeRanker:
+    """Per-user node ordering by spare capacity, region and health
+
+    Uses weighted rendezvous hashing: every (user, node) pair gets a
+    stable pseudo-random draw scaled by the node's weight, and nodes are
+    sorted by score. A user keeps the same first choice until weights
+    change noticeably, and users spread over nodes in proportion to their
+    spare capacity. Load ratios are quantised to tenths so small load
+    fluctuations don't reshuffle everyone.
+    """
+
+    # Bumped whenever anything outside nodes.json affects ranking
+    version = 0
+
+    @staticmethod
+    def health_factor(record):
+        """Weight multiplier from node health, 0 excludes the node"""
+        if not record.healthy:
+            return 0.0
+        return HealthMonitor.factor(record.name)
+
+    @staticmethod
+    def weight(record, region):
+        """Ranking weight for a node as seen from a requester region"""
+        weight = record.weight
+        if region and record.region == region:
+            weight *= CONFIG['REGION_BOOST']
+        return weight * NodeRanker.health_factor(record)
 
-class UserManager:
-    """Manages user data with caching and sync"""
-    
     @staticmethod
-    def get_users():
-        """Get users with cache"""
-        if CONFIG['NODE_TYPE'] == 'master':
-            # Master node: Load from database/file
-            return UserManager.load_from_database()
-        else:
-            # Client node: Get from cache or sync
-            if UserManager.cache_expired():
-                UserManager.sync_from_master()
-            return CACHE['users']
-    
+    def order(user, records, region):
+        """Indexes of nodes (NodeRecords of a snapshot) to offer this user, best first"""
+        scored = []
+        user_key = user.encode()
+        for index, record in enumerate(records):
+            weight = NodeRanker.weight(record, region)
+            if weight <= 0:
+                continue
+            digest = hashlib.blake2b(user_key + record.hash_key, digest_size=8).digest()
+            draw = (int.from_bytes(digest, 'big') + 1) / 2.0 ** 64
+            scored.append((weight / -math.log(draw), index))
+        if not scored:
+            # Everything is excluded; offering all nodes beats offering none
+            return list(range(len(records)))
+        scored.sort(reverse=True)
+        ranked = [index for _, index in scored]
+        if CONFIG['SUB_MAX_NODES']:
+            ranked = ranked[:CONFIG['SUB_MAX_NODES']]
+        return ranked
+
+class HealthMonitor:
+    """Background prober for node TLS ports with hysteresis
+
+    Every HEALTH_INTERVAL seconds each node gets a TCP connect plus TLS
+    handshake. A node is marked down after HEALTH_FALL consecutive failed
+    probes and back up after HEALTH_RISE consecutive successes, so a single
+    lost packet doesn't flap it; being slow is counted the same way. Down
+    nodes are dropped from subscriptions; slow ones are demoted. Nodes that
+    haven't been probed yet count as up.
+
+    One process per host probes and writes its results to
+    DATA_DIR/node-health.json; the other gunicorn workers adopt that file,
+    so every worker ranks nodes, and tags bodies, the same way.
+    """
+
+    # node name -> probe state
+    status = {}
+    lock = threading.Lock()
+    tls_context = ssl.create_default_context()
+    # We check liveness, not identity; nodes may be addressed by IP
+    tls_context.check_hostname = False
+    tls_context.verify_mode = ssl.CERT_NONE
+
     @staticmethod
-    def cache_expired():
-        """Check if cache needs refresh"""
-        return time.time() - CACHE['last_sync'] > CONFIG['CACHE_TTL']
-    
+    def probe(host, port):
+        """Handshake latency in milliseconds; raises on failure"""
+        start = time.perf_counter()
+        with socket.create_connection((host, port), timeout=CONFIG['HEALTH_TIMEOUT']) as sock:
+            if CONFIG['HEALTH_TLS']:
+                with HealthMonitor.tls_context.wrap_socket(sock, server_hostname=host):
+                    pass
+        return (time.perf_counter() - start) * 1000
+
+    @staticmethod
+    def record(name, latency_ms, error):
+        """Fold one probe result into the node's state"""
+        with HealthMonitor.lock:
+            state = HealthMonitor.status.setdefault(name, {
+                'healthy': True, 'slow': False, 'latency_ms': None,
+                'successes': 0, 'failures': 0, 'slow_probes': 0, 'fast_probes': 0,
+                'checked_at': 0, 'error': None
+            })
+            before = (state['healthy'], state['slow'])
+            state['checked_at'] = time.time()
+            state['error'] = error
+            if error is None:
+                state['latency_ms'] = round(latency_ms, 1)
+                if latency_ms > CONFIG['HEALTH_SLOW_MS']:
+                    state['slow_probes'] += 1
+                    state['fast_probes'] = 0
+                    if state['slow_probes'] >= CONFIG['HEALTH_FALL']:
+                        state['slow'] = True
+                else:
+                    state['fast_probes'] += 1
+                    state['slow_probes'] = 0
+                    if state['fast_probes'] >= CONFIG['HEALTH_RISE']:
+                        state['slow'] = False
+                state['successes'] += 1
+                state['failures'] = 0
+                if state['successes'] >= CONFIG['HEALTH_RISE']:
+                    state['healthy'] = True
+            else:
+                state['failures'] += 1
+                state['successes'] = 0
+                if state['failures'] >= CONFIG['HEALTH_FALL']:
+                    state['healthy'] = False
+            if (state['healthy'], state['slow']) != before:
+                # Re-rank subscriptions with the new health
+                NodeRanker.version += 1
+
     @staticmethod
-    def sync_from_master():
-        """Sync users from master node"""
+    def check(node):
+        """Probe one node and record the outcome"""
         try:
-            headers = {
-                'Authorization': f"Bearer {UserManager.generate_token()}",
-                'X-Node-Name': CONFIG['NODE_NAME']
-            }
-            response = requests.get(
-                f"{CONFIG['MASTER_API']}/api/v1/sync", 
-                headers=headers, 
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                CACHE['users'] = data.get('users', {})
-                CACHE['nodes'] = data.get('nodes', [])
-                CACHE['last_sync'] = time.time()
-                return True
+            latency_ms = HealthMonitor.probe(node['host'], node['port'])
+            HealthMonitor.record(node['name'], latency_ms, None)
         except Exception as e:
-            app.logger.error(f"Sync failed: {e}")
-        return False
-    
+            HealthMonitor.record(node['name'], None, str(e) or type(e).__name__)
+
     @staticmethod
-    def load_from_database():
-        """Load users from database (or file for now)"""
-        # In production, this would query a database
+    def check_all(pool):
+        """Probe every node concurrently"""
+        nodes = NodeManager.get_all_nodes()
+        list(pool.map(HealthMonitor.check, nodes))
+        names = {node['name'] for node in nodes}
+        with HealthMonitor.lock:
+            for name in list(HealthMonitor.status):
+                if name not in names:
+                    del HealthMonitor.status[name]
+
+    @staticmethod
+    def path():
+        return os.path.join(CONFIG['DATA_DIR'], 'node-health.json')
+
+    @staticmethod
+    def prober():
+        """True if this process probes for the host"""
+        try:
+            return host_lock('health')
+        except OSError:
+            # No usable DATA_DIR to coordinate through; probe ourselves
+            return True
+
+    @staticmethod
+    def share():
+        """Write the probe state for the other workers on this host"""
+        with HealthMonitor.lock:
+            data = json.dumps(HealthMonitor.status).encode()
         try:
-            with open('/opt/vpn-subscription/users.json', 'r') as f:
-                return json.load(f)
-        except:
-            # Default users if file doesn't exist
+            write_file_atomic(HealthMonitor.path(), data)
+        except OSError:
+            # No usable DATA_DIR, so no other workers sharing it either
+            pass
+
+    @staticmethod
+    def adopt(seen):
+        """Take over the prober's results if its file changed; returns the file signature seen"""
+        signature = file_signature(HealthMonitor.path())
+        if signature is None or signature == seen:
+            return seen
+        with open(HealthMonitor.path(), 'rb') as f:
+            status = json.loads(f.read())
+        with HealthMonitor.lock:
+            before = {name: (state['healthy'], state['slow']) for name, state in HealthMonitor.status.items()}
+            HealthMonitor.status = status
+            if {name: (state['healthy'], state['slow']) for name, state in status.items()} != before:
+                NodeRanker.version += 1
+        return signature
+
+    @staticmethod
+    def run():
+        """Probe loop, or follow the probing worker's results"""
+        seen = None
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix='health-probe') as pool:
+            while True:
+                delay = CONFIG['HEALTH_INTERVAL']
+                try:
+                    if HealthMonitor.prober():
+                        HealthMonitor.check_all(pool)
+                        HealthMonitor.share()
+                    else:
+                        # Check often so workers disagree for a second at most
+                        delay = min(delay, 1)
+                        seen = HealthMonitor.adopt(seen)
+                except Exception as e:
+                    app.logger.error(f"Health check failed: {e}")
+                time.sleep(delay)
+
+    @staticmethod
+    def start():
+        """Run the probe loop in a daemon thread"""
+        thread = threading.Thread(target=HealthMonitor.run, name='health-monitor', daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def factor(name):
+        """Ranking multiplier: 0 when down, demoted when slow"""
+        state = HealthMonitor.status.get(name)
+        if state is None:
+            return 1.0
+        if not state['healthy']:
+            return 0.0
+        return 0.25 if state['slow'] else 1.0
+
+    @staticmethod
+    def report():
+        """Probe state per node for /health and metrics"""
+        with HealthMonitor.lock:
             return {
-                "testuser": "3b331a0b-fe16-4c0a-9e25-26ba0ac6f57b",
-                "ali": "aae97e4b-8509-4c9b-8f1c-8c5095e1497b"
+                name: {
+                    'healthy': state['healthy'],
+                    'slow': state['slow'],
+                    'latency_ms': state['latency_ms'],
+                    'consecutive_failures': state['failures'],
+                    'checked_at': int(state['checked_at']),
+                    'error': state['error']
+                }
+                for name, state in HealthMonitor.status.items()
             }
-    
+
+def read_varint(data, pos):
+    """Decode a protobuf varint at pos; returns (value, next pos)"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def protobuf_fields(data):
+    """Yield (field number, value) from an encoded message; value is int or bytes"""
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire_type in (1, 5):
+            size = 8 if wire_type == 1 else 4
+            value, pos = int.from_bytes(data[pos:pos + size], 'little'), pos + size
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field, value
+
+class XrayStats:
+    """Reads every xray traffic counter in one QueryStats call
+
+    Uses the gRPC API directly when the grpcio package is installed. The
+    two messages involved are tiny, so they are encoded by hand instead
+    of shipping generated stubs. Without grpcio it falls back to the
+    `xray api statsquery` command, which makes the same single call.
+    """
+
+    METHOD = '/xray.app.stats.command.StatsService/QueryStats'
+    # QueryStatsRequest{pattern: "", reset: false} encodes to nothing: match all, keep counters
+    QUERY_ALL = b''
+
+    channel = None
+
     @staticmethod
-    def save_to_database(users):
-        """Save users to database"""
-        with open('/opt/vpn-subscription/users.json', 'w') as f:
-            json.dump(users, f, indent=2)
-    
+    def query():
+        """{counter name: value} for every counter xray has"""
+        if grpc is not None:
+            return XrayStats.query_grpc()
+        return XrayStats.query_cli()
+
     @staticmethod
-    def generate_token():
-        """Generate JWT token for inter-node communication"""
-        payload = {
+    def query_grpc():
+        if XrayStats.channel is None:
+            XrayStats.channel = grpc.insecure_channel(CONFIG['XRAY_API'])
+        call = XrayStats.channel.unary_unary(XrayStats.METHOD)
+        return XrayStats.decode(call(XrayStats.QUERY_ALL, timeout=5))
+
+    @staticmethod
+    def decode(data):
+        """Parse a QueryStatsResponse (repeated Stat{name = 1, value = 2} stat = 1)"""
+        counters = {}
+        for field, stat in protobuf_fields(data):
+            if field != 1:
+                continue
+            name, value = '', 0
+            for stat_field, stat_value in protobuf_fields(stat):
+                if stat_field == 1:
+                    name = stat_value.decode()
+                elif stat_field == 2:
+                    # int64 on the wire; negative values are two's complement
+                    value = stat_value - (1 << 64) if stat_value >= 1 << 63 else stat_value
+            counters[name] = value
+        return counters
+
+    @staticmethod
+    def query_cli():
+        result = subprocess.run(
+            [CONFIG['XRAY_BIN'], 'api', 'statsquery', f"--server={CONFIG['XRAY_API']}"],
+            capture_output=True, text=True, timeout=10, check=True
+        )
+        stats = json.loads(result.stdout or '{}').get('stat') or []
+        # protojson renders int64 as a string and omits zero values
+        return {stat['name']: int(stat.get('value', 0)) for stat in stats}
+
+class TrafficCollector:
+    """Per-user and per-inbound traffic rates from xray's counters
+
+    Every STATS_INTERVAL seconds all counters are read in one call and the
+    increase since the previous read is added to the current slot. Slots
+    cover STATS_SLOT_SECONDS each and the last STATS_SLOTS are kept in a
+    ring, holding only the users that moved traffic in that slot, so
+    memory follows active users rather than all users.
+
+    The x-ui panel reads the same counters with reset, so a counter
+    smaller than last time means it was reset and its whole value is new
+    traffic. Traffic between our last read and x-ui's reset is missed, so
+    rates are a lower bound while the panel is running.
+
+    Only one process per host collects: gunicorn workers compete for a
+    lock file, and the holder reports after each slot closes.
+    """
+
+    last = None
+    slot = None
+    ring = deque(maxlen=CONFIG['STATS_SLOTS'])
+    lock = threading.Lock()
+
+    @staticmethod
+    def parse(name):
+        """('user'|'inbound', key, 'uplink'|'downlink') for a counter name, or None"""
+        parts = name.split('>>>')
+        if len(parts) != 4 or parts[2] != 'traffic' or parts[0] not in ('user', 'inbound'):
+            return None
+        kind, key, _, direction = parts
+        if kind == 'inbound' and key == 'api':
+            return None
+        if kind == 'user' and '@' in key:
+            # x-ui client emails map to usernames the same way xui_sync does
+            key = key.split('@')[0]
+        return kind, key, direction
+
+    @staticmethod
+    def new_slot(now):
+        return {'start': now, 'seconds': 0.0, 'users': {}, 'inbounds': {}}
+
+    @staticmethod
+    def sample(counters, now):
+        """Fold one read of all counters into the current slot"""
+        with TrafficCollector.lock:
+            previous, TrafficCollector.last = TrafficCollector.last, (now, counters)
+            if previous is None:
+                TrafficCollector.slot = TrafficCollector.new_slot(now)
+                return
+            last_time, last_counters = previous
+            slot = TrafficCollector.slot
+            slot['seconds'] += now - last_time
+            for name, value in counters.items():
+                parsed = TrafficCollector.parse(name)
+                if parsed is None:
+                    continue
+                before = last_counters.get(name, 0)
+                delta = value - before if value >= before else value
+                if delta <= 0:
+                    continue
+                kind, key, direction = parsed
+                totals = slot['users' if kind == 'user' else 'inbounds'].setdefault(key, [0, 0])
+                totals[0 if direction == 'uplink' else 1] += delta
+
+    @staticmethod
+    def rotate(now):
+        """Close the current slot once it is STATS_SLOT_SECONDS old; True if it was"""
+        with TrafficCollector.lock:
+            slot = TrafficCollector.slot
+            if slot is None or now - slot['start'] < CONFIG['STATS_SLOT_SECONDS']:
+                return False
+            TrafficCollector.ring.append(slot)
+            TrafficCollector.slot = TrafficCollector.new_slot(now)
+            return True
+
+    @staticmethod
+    def rates(slots, kind):
+        """{key: [uplink, downlink] bytes/s} over the given slots"""
+        seconds = sum(slot['seconds'] for slot in slots) or 1
+        totals = {}
+        for slot in slots:
+            for key, (up, down) in slot[kind].items():
+                entry = totals.setdefault(key, [0, 0])
+                entry[0] += up
+                entry[1] += down
+        return {key: [round(up / seconds, 1), round(down / seconds, 1)] for key, (up, down) in totals.items()}
+
+    @staticmethod
+    def summary():
+        """Report for the master: node rates for the last slot and the window, top users"""
+        with TrafficCollector.lock:
+            slots = list(TrafficCollector.ring)
+        if not slots:
+            return None
+        window_users = TrafficCollector.rates(slots, 'users')
+        last_users = TrafficCollector.rates(slots[-1:], 'users')
+
+        def node_rates(users, seconds):
+            return {
+                'up_bps': round(sum(up for up, _ in users.values()), 1),
+                'down_bps': round(sum(down for _, down in users.values()), 1),
+                'active_users': len(users),
+                'seconds': round(seconds, 1)
+            }
+
+        top = sorted(window_users.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+        return {
             'node': CONFIG['NODE_NAME'],
-            'exp': datetime.utcnow() + timedelta(minutes=5)
+            'timestamp': time.time(),
+            'last': node_rates(last_users, slots[-1]['seconds']),
+            'window': node_rates(window_users, sum(slot['seconds'] for slot in slots)),
+            'inbounds': TrafficCollector.rates(slots, 'inbounds'),
+            'top_users': [[user, up, down] for user, (up, down) in top[:CONFIG['STATS_TOP_USERS']]]
         }
-        return jwt.encode(payload, CONFIG['JWT_SECRET'], algorithm='HS256')
-    
+
     @staticmethod
-    def verify_token(token):
-        """Verify JWT token"""
+    def report(summary):
+        """Hand a summary to the master: directly when we are it, else over HTTP"""
+        if CONFIG['NODE_TYPE'] == 'master':
+            NodeStats.record(summary)
+            return
         try:
-            jwt.decode(token, CONFIG['JWT_SECRET'], algorithms=['HS256'])
-            return True
-        except:
-            return False
+            response = SyncClient.request('POST', '/api/v1/stats', 'stats', json=summary, timeout=5)
+            if response.status_code != 200:
+                app.logger.error(f"Stats report failed: HTTP {response.status_code}")
+        except Exception as e:
+            app.logger.error(f"Stats report failed: {e}")
 
-class NodeManager:
-    """Manages distributed nodes"""
-    
     @staticmethod
-    def get_all_nodes():
-        """Get all registered nodes"""
-        if CONFIG['NODE_TYPE'] == 'master':
-            return NodeManager.load_nodes()
-        else:
-            return CACHE.get('nodes', [])
-    
+    def run():
+        """Collection loop"""
+        while True:
+            try:
+                if host_lock('stats'):
+                    now = time.time()
+                    TrafficCollector.sample(XrayStats.query(), now)
+                    if TrafficCollector.rotate(now):
+                        summary = TrafficCollector.summary()
+                        if summary:
+                            TrafficCollector.report(summary)
+            except Exception as e:
+                app.logger.error(f"Stats collection failed: {e}")
+            time.sleep(CONFIG['STATS_INTERVAL'])
+
     @staticmethod
-    def load_nodes():
-        """Load nodes configuration"""
-        try:
-            with open('/opt/vpn-subscription/nodes.json', 'r') as f:
-                return json.load(f)
-        except:
-            return [
-                {"name": "Finland", "host": "freedomacrossborders.shop", "port": 8443, "region": "EU"},
-                {"name": "Bahrain", "host": "154.205.146.39", "port": 8443, "region": "ME"}
+    def start():
+        """Run the collection loop in a daemon thread"""
+        thread = threading.Thread(target=TrafficCollector.run, name='traffic-collector', daemon=True)
+        thread.start()
+        return thread
+
+class NodeStats:
+    """Latest traffic report from every node, kept on the master"""
+
+    reports = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def record(summary):
+        """Keep a report; on the master its active users become the node's load"""
+        with NodeStats.lock:
+            NodeStats.reports[summary['node']] = dict(summary, received_at=time.time())
+        active_users = (summary.get('window') or {}).get('active_users')
+        if CONFIG['NODE_TYPE'] == 'master' and isinstance(active_users, int):
+            NodeManager.record_load(summary['node'], active_users)
+
+    @staticmethod
+    def current():
+        """Reports younger than three slots; older ones belong to silent nodes"""
+        cutoff = time.time() - 3 * CONFIG['STATS_SLOT_SECONDS']
+        with NodeStats.lock:
+            return {name: report for name, report in NodeStats.reports.items() if report['received_at'] >= cutoff}
+
+    @staticmethod
+    def overview():
+        """Per-node rates and the hottest users across all nodes"""
+        reports = NodeStats.current()
+        users = {}
+        for report in reports.values():
+            for user, up, down in report['top_users']:
+                entry = users.setdefault(user, [0, 0])
+                entry[0] += up
+                entry[1] += down
+        top = sorted(users.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+        return {
+            'nodes': {
+                name: {
+                    'last': report['last'],
+                    'window': report['window'],
+                    'inbounds': report['inbounds'],
+                    'received_at': int(report['received_at'])
+                }
+                for name, report in reports.items()
+            },
+            'top_users': [
+                {'user': user, 'up_bps': round(up, 1), 'down_bps': round(down, 1)}
+                for user, (up, down) in top[:CONFIG['STATS_TOP_USERS']]
             ]
-    
+        }
+
+# Placeholder substituted with the client UUID when rendering a subscription
+CLIENT_ID_MARKER = '\x00client-id\x00'
+
+class LinkBuilder:
+    """Turns a node's inbound specs into share links, compiled once per node set
+
+    Nodes list their inbounds in nodes.json (published from x-ui.db by
+    sync/xui_inbounds.py); nodes without them get the original VLESS over
+    TLS/TCP link. Each link is compiled into text around the client id,
+    so rendering for a user is a join. VMess links are base64 JSON: the
+    JSON before the id is padded to a multiple of 3 bytes, so its base64
+    ends on a block boundary and the user's part can be encoded on its own.
+    Trojan links use the client id as the password, so xui_inbounds.py only
+    publishes trojan inbounds whose clients' passwords equal their ids.
+    """
+
     @staticmethod
-    def register_node(node_data):
-        """Register a new node"""
-        nodes = NodeManager.load_nodes()
-        # Update or add node
-        for i, node in enumerate(nodes):
-            if node['name'] == node_data['name']:
-                nodes[i] = node_data
-                break
+    def specs(node):
+        """Inbound specs of a node, defaulting to VLESS over TLS/TCP on its port"""
+        return node.get('inbounds') or [{
+            'protocol': 'vless', 'port': node['port'], 'network': 'tcp',
+            'security': 'tls', 'sni': node['host'], 'alpn': 'h2,http/1.1'
+        }]
+
+    @staticmethod
+    def label(node, spec, count):
+        """Link name shown in client apps; protocol and transport added when a node has several"""
+        if count == 1:
+            return node['name']
+        return f"{node['name']}-{spec['protocol']}-{spec.get('network', 'tcp')}"
+
+    @staticmethod
+    def query(spec, host):
+        """URL query string for vless and trojan links"""
+        network = spec.get('network', 'tcp')
+        params = []
+        if spec['protocol'] == 'vless':
+            params.append(('encryption', 'none'))
+        params.append(('security', spec.get('security', 'none')))
+        if spec.get('security') == 'tls':
+            params.append(('sni', spec.get('sni') or host))
+            for key in ('alpn', 'fp'):
+                if spec.get(key):
+                    params.append((key, spec[key]))
+        if spec['protocol'] == 'vless' and spec.get('flow'):
+            params.append(('flow', spec['flow']))
+        params.append(('type', network))
+        if network == 'tcp' and spec.get('header_type') == 'http':
+            params += [('headerType', 'http'), ('host', spec.get('host', '')), ('path', spec.get('path', '/'))]
+        elif network == 'ws':
+            if spec.get('host'):
+                params.append(('host', spec['host']))
+            params.append(('path', spec.get('path', '/')))
+        elif network == 'grpc':
+            params.append(('serviceName', spec.get('service_name', '')))
+            if spec.get('mode'):
+                params.append(('mode', spec['mode']))
+        return '&'.join(f"{key}={quote(str(value), safe='')}" for key, value in params)
+
+    @staticmethod
+    def vmess_json(node, spec, label, client_id):
+        """v2rayN-style VMess share object"""
+        network = spec.get('network', 'tcp')
+        tls = spec.get('security') == 'tls'
+        return json.dumps({
+            'v': '2', 'ps': label, 'add': node['host'], 'port': str(spec.get('port', node['port'])),
+            'id': client_id, 'aid': '0', 'scy': 'auto', 'net': network,
+            'type': spec.get('mode', 'gun') if network == 'grpc' else spec.get('header_type', 'none'),
+            'host': spec.get('host', ''),
+            'path': spec.get('service_name', '') if network == 'grpc' else spec.get('path', ''),
+            'tls': 'tls' if tls else '', 'sni': (spec.get('sni') or node['host']) if tls else '',
+            'alpn': spec.get('alpn', ''), 'fp': spec.get('fp', '')
+        }, separators=(',', ':'))
+
+    @staticmethod
+    def link(node, spec, label, client_id):
+        """One share link, built from scratch"""
+        port = spec.get('port', node['port'])
+        if spec['protocol'] == 'vmess':
+            return 'vmess://' + base64.b64encode(LinkBuilder.vmess_json(node, spec, label, client_id).encode()).decode()
+        return f"{spec['protocol']}://{client_id}@{node['host']}:{port}?{LinkBuilder.query(spec, node['host'])}#{label}"
+
+    @staticmethod
+    def compile(node):
+        """Templates for every link of a node
+
+        (prefix, suffix) for plain links; for VMess (prefix, suffix, json
+        prefix, json suffix), the last two for ids whose length isn't a
+        multiple of 3.
+        """
+        specs = LinkBuilder.specs(node)
+        templates = []
+        for spec in specs:
+            label = LinkBuilder.label(node, spec, len(specs))
+            if spec['protocol'] != 'vmess':
+                templates.append(tuple(LinkBuilder.link(node, spec, label, CLIENT_ID_MARKER).split(CLIENT_ID_MARKER)))
+                continue
+            # json.dumps escapes the marker's NULs
+            marker = json.dumps(CLIENT_ID_MARKER)[1:-1]
+            head, tail = LinkBuilder.vmess_json(node, spec, label, CLIENT_ID_MARKER).split(marker)
+            # Whitespace after '{' is valid JSON and aligns the id to a base64 block
+            head = '{' + ' ' * (-len(head) % 3) + head[1:]
+            templates.append((
+                'vmess://' + base64.b64encode(head.encode()).decode(),
+                base64.b64encode(tail.encode()).decode(),
+                head, tail
+            ))
+        return templates
+
+    @staticmethod
+    def fill(template, client_id):
+        """Render one compiled template for a client id"""
+        if len(template) == 2:
+            return client_id.join(template)
+        encoded_id = client_id.encode()
+        if len(encoded_id) % 3 == 0:
+            return template[0] + base64.b64encode(encoded_id).decode() + template[1]
+        return 'vmess://' + base64.b64encode((template[2] + client_id + template[3]).encode()).decode()
+
+class SubscriptionRenderer:
+    """Renders subscription bodies once per user/node-set/ranking version"""
+
+    # username -> (client_id, render key, raw, encoded, etag)
+    rendered = {}
+
+    @staticmethod
+    def render(user, client_id, region=None, snapshot=None):
+        """Return (raw, encoded, etag) for a user, rendering only on change
+
+        Links come from the node records of snapshot (the current one by
+        default), compiled when that node set was first published.
+        """
+        snapshot = snapshot or Snapshot.current
+        key = (snapshot.nodes_version, NodeRanker.version, region)
+        entry = SubscriptionRenderer.rendered.get(user)
+        if entry and entry[0] == client_id and entry[1] == key:
+            Metrics.inc('vpnsub_render_cache_total', (('result', 'hit'),))
+            return entry[2], entry[3], entry[4]
+        Metrics.inc('vpnsub_render_cache_total', (('result', 'miss'),))
+
+        records = snapshot.records
+        raw = '\n'.join(
+            client_id.join(template) if len(template) == 2 else LinkBuilder.fill(template, client_id)
+            for i in NodeRanker.order(user, records, region) for template in records[i].templates
+        )
+        encoded = base64.b64encode(raw.encode()).decode()
+        etag = hashlib.sha1(raw.encode()).hexdigest()[:20]
+        SubscriptionRenderer.rendered[user] = (client_id, key, raw, encoded, etag)
+        return raw, encoded, etag
+
+    @staticmethod
+    def forget(user):
+        """Drop a cached body for a user that no longer exists"""
+        SubscriptionRenderer.rendered.pop(user, None)
+
+def too_many_requests(scope, retry_after):
+    """429 response telling the client when to come back"""
+    Metrics.inc('vpnsub_rate_limited_total', (('scope', scope),))
+    response = Response("Too many requests", status=429, mimetype='text/plain')
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def subscription_response(user, raw_format):
+    """Serve a cached subscription body with a strong ETag"""
+    retry_after = RateLimiter.check('ip', requester_ip())
+    if retry_after:
+        return too_many_requests('ip', retry_after)
+
+    if NegativeCache.contains(user):
+        Metrics.inc('vpnsub_negative_cache_total')
+        return Response("User not found", status=404)
+
+    # One snapshot for the whole request: the user and the nodes belong together
+    snapshot = UserManager.current()
+    client_id = snapshot.users.get(user)
+
+    if not client_id:
+        SubscriptionRenderer.forget(user)
+        NegativeCache.add(user, (snapshot.epoch, snapshot.revision))
+        return Response("User not found", status=404)
+
+    retry_after = RateLimiter.check('user', user)
+    if retry_after:
+        return too_many_requests('user', retry_after)
+
+    raw, encoded, etag = SubscriptionRenderer.render(user, client_id, requester_region(), snapshot)
+    # Raw and encoded bodies differ, so they need distinct strong ETags
+    etag = f"r-{etag}" if raw_format else f"b-{etag}"
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(raw if raw_format else encoded, mimetype='text/plain')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+class StaticExporter:
+    """Writes every user's subscription as files for nginx to serve directly
+
+    EXPORT_DIR/b64/<user> holds the base64 body of /sub/<user> and
+    EXPORT_DIR/raw/<user> the body of /sub/<user>/raw, each with a .gz
+    sibling for gzip_static when EXPORT_GZIP is on. Files come from the
+    same renderer as the dynamic endpoint (with no requester region) and
+    are replaced by rename, so nginx never serves a partial file.
+
+    Exports are incremental. The exporter remembers the ETag it wrote for
+    each user and rewrites only users whose body changed. On the first
+    pass after startup it compares against the files already on disk, so
+    a restart rewrites nothing that is still current. Usernames that can't
+    be file names are left to the dynamic endpoint.
+    """
+
+    SAFE_NAME = re.compile(r'[A-Za-z0-9_@+-][A-Za-z0-9._@+-]{0,127}')
+
+    # username -> etag of the files on disk, None until the first pass
+    exported = None
+    last_key = None
+
+    @staticmethod
+    def exportable(user):
+        """Whether a username can be a file name without colliding with .gz/.tmp files"""
+        return bool(StaticExporter.SAFE_NAME.fullmatch(user)) and not user.endswith('.gz')
+
+    @staticmethod
+    def paths(user):
+        """(raw_format, path) for each file of a user"""
+        return [(False, os.path.join(CONFIG['EXPORT_DIR'], 'b64', user)),
+                (True, os.path.join(CONFIG['EXPORT_DIR'], 'raw', user))]
+
+    @staticmethod
+    def write(user, raw, encoded):
+        for raw_format, path in StaticExporter.paths(user):
+            body = (raw if raw_format else encoded).encode()
+            if CONFIG['EXPORT_GZIP']:
+                # Fixed mtime keeps the .gz reproducible
+                write_file_atomic(f"{path}.gz", gzip.compress(body, 9, mtime=0))
+            elif os.path.exists(f"{path}.gz"):
+                os.unlink(f"{path}.gz")
+            write_file_atomic(path, body)
+
+    @staticmethod
+    def remove(user):
+        for _, path in StaticExporter.paths(user):
+            for name in (path, f"{path}.gz"):
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def on_disk(user, raw):
+        """True if the user's raw file already holds this body (first pass only)"""
+        try:
+            with open(StaticExporter.paths(user)[1][1], 'rb') as f:
+                return f.read() == raw.encode()
+        except OSError:
+            return False
+
+    @staticmethod
+    def export():
+        """Bring EXPORT_DIR up to date; returns (users rewritten, users removed)"""
+        for directory in ('b64', 'raw'):
+            os.makedirs(os.path.join(CONFIG['EXPORT_DIR'], directory), exist_ok=True)
+        first_pass = StaticExporter.exported is None
+        exported = {} if first_pass else StaticExporter.exported
+        snapshot = UserManager.current()
+        users = {user: client_id for user, client_id in snapshot.users.items()
+                 if client_id and StaticExporter.exportable(user)}
+
+        written = 0
+        for user, client_id in users.items():
+            raw, encoded, etag = SubscriptionRenderer.render(user, client_id, None, snapshot)
+            if exported.get(user) == etag:
+                continue
+            if not (first_pass and StaticExporter.on_disk(user, raw)):
+                StaticExporter.write(user, raw, encoded)
+                written += 1
+            exported[user] = etag
+
+        if first_pass:
+            stale = set(os.listdir(os.path.join(CONFIG['EXPORT_DIR'], 'raw')))
+            stale = {name[:-3] if name.endswith('.gz') else name for name in stale if not name.startswith('.')}
         else:
-            nodes.append(node_data)
-        
-        with open('/opt/vpn-subscription/nodes.json', 'w') as f:
-            json.dump(nodes, f, indent=2)
-        return True
+            stale = set(exported)
+        removed = 0
+        for user in stale - set(users):
+            StaticExporter.remove(user)
+            exported.pop(user, None)
+            removed += 1
+
+        StaticExporter.exported = exported
+        Metrics.inc('vpnsub_export_files_total', (('action', 'write'),), written)
+        Metrics.inc('vpnsub_export_files_total', (('action', 'remove'),), removed)
+        return written, removed
+
+    @staticmethod
+    def version_key():
+        """Changes whenever any exported body could change"""
+        snapshot = Snapshot.current
+        return snapshot.epoch, snapshot.revision, snapshot.nodes_version, NodeRanker.version
+
+    @staticmethod
+    def run():
+        """Export loop: one process per host, re-exporting after any change"""
+        while True:
+            try:
+                if host_lock('export'):
+                    key = StaticExporter.version_key()
+                    if key != StaticExporter.last_key:
+                        written, removed = StaticExporter.export()
+                        StaticExporter.last_key = key
+                        if written or removed:
+                            app.logger.info(f"Exported {written} subscriptions, removed {removed}")
+            except Exception as e:
+                app.logger.error(f"Static export failed: {e}")
+            time.sleep(CONFIG['EXPORT_INTERVAL'])
+
+    @staticmethod
+    def start():
+        """Run the export loop in a daemon thread"""
+        thread = threading.Thread(target=StaticExporter.run, name='static-export', daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def check():
+        """Compare every exported file with the dynamic endpoint; returns mismatching paths"""
+        # The check's own requests must not be throttled
+        CONFIG['RATE_LIMIT'] = False
+        client = app.test_client()
+        mismatches = []
+        for user in UserManager.snapshot_users():
+            if not StaticExporter.exportable(user):
+                continue
+            for raw_format, path in StaticExporter.paths(user):
+                expected = client.get(f"/sub/{user}/raw" if raw_format else f"/sub/{user}").get_data()
+                try:
+                    with open(path, 'rb') as f:
+                        same = f.read() == expected
+                    if same and CONFIG['EXPORT_GZIP']:
+                        with open(f"{path}.gz", 'rb') as f:
+                            same = gzip.decompress(f.read()) == expected
+                except OSError:
+                    same = False
+                if not same:
+                    mismatches.append(path)
+        return mismatches
 
 # API Routes
 @app.route('/api/v1/sync')
 def api_sync():
-    """Sync endpoint for client nodes"""
-    if CONFIG['NODE_TYPE'] != 'master':
-        return jsonify({"error": "This node is not a master"}), 403
+    """Sync endpoint for client nodes and replicas"""
+    if CONFIG['NODE_TYPE'] == 'client':
+        return jsonify({"error": "This node is not a master or replica"}), 403
     
     # Verify authentication
     auth_header = request.headers.get('Authorization', '')
@@ -171,12 +2787,102 @@ def api_sync():
     if not UserManager.verify_token(token):
         return jsonify({"error": "Invalid token"}), 401
     
-    # Return users and nodes
-    return jsonify({
-        "users": UserManager.get_users(),
-        "nodes": NodeManager.get_all_nodes(),
+    if CONFIG['NODE_TYPE'] == 'replica' and Snapshot.current.epoch is None:
+        # Never synced (master down since we started); don't hand out an empty user list
+        return jsonify({"error": "Replica has not synced yet"}), 503
+    
+    since = request.args.get('since', type=int)
+    if since is not None:
+        epoch = request.args.get('epoch')
+        wait = min(request.args.get('wait', 0, type=float), CONFIG['LONG_POLL_TIMEOUT'])
+        if wait > 0 and epoch == CHANGELOG.epoch:
+            # Long-poll: hold the request until something changes
+            held = CHANGELOG.wait(epoch, since, wait)
+            Metrics.inc('vpnsub_long_polls_total', (
+                ('result', 'refused' if held is None else 'held'), ('node', request.headers.get('X-Node-Name', 'unknown'))
+            ))
+        delta = CHANGELOG.since(epoch, since)
+        if delta is not None:
+            return encoded_response(json.dumps(delta_payload(*delta)).encode(), 'application/json')
+    
+    return full_snapshot_response()
+
+# Last encoded full snapshot as one (key, body, mimetype, encoding) tuple, so
+# clients resyncing at the same revision share one encode; replaced, never mutated
+SNAPSHOT_CACHE = {'entry': (None, None, None, None)}
+
+def full_snapshot_response():
+    """Full sync payload, binary or JSON as negotiated, compressed once per revision"""
+    mimetype = 'application/json'
+    if request.accept_mimetypes.best_match(['application/json', SNAPSHOT_MIMETYPE]) == SNAPSHOT_MIMETYPE:
+        mimetype = SNAPSHOT_MIMETYPE
+    encoding = negotiate_encoding()
+    current = UserManager.current()
+    key = (current.epoch, current.revision, mimetype, encoding)
+    entry = SNAPSHOT_CACHE['entry']
+    if entry[0] != key:
+        snapshot = {
+            "mode": "full",
+            "epoch": current.epoch,
+            "revision": current.revision,
+            "users": current.users.to_dict(),
+            "nodes": list(current.nodes),
+            "timestamp": time.time()
+        }
+        if mimetype == SNAPSHOT_MIMETYPE:
+            body = pack_snapshot(snapshot)
+        else:
+            body = json.dumps(snapshot, separators=(',', ':')).encode()
+        body, encoding = compress_body(body, encoding)
+        entry = (key, body, mimetype, encoding)
+        SNAPSHOT_CACHE['entry'] = entry
+    return build_response(entry[1], entry[2], entry[3])
+
+def negotiate_encoding():
+    """Best compression the client accepts: zstd, then gzip, else None"""
+    offered = ['zstd', 'gzip'] if zstandard else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+def compress_body(body, encoding):
+    """Compress body with encoding; tiny bodies are left alone"""
+    if encoding is None or len(body) < 1024:
+        return body, None
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body), encoding
+    return gzip.compress(body, compresslevel=5), encoding
+
+def build_response(body, mimetype, encoding):
+    response = Response(body, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+def encoded_response(body, mimetype):
+    """Response compressed with the best encoding the client accepts"""
+    body, encoding = compress_body(body, negotiate_encoding())
+    return build_response(body, mimetype, encoding)
+
+def delta_payload(revision, changes):
+    """Shape collapsed change-log entries into a delta sync response"""
+    users = changes['user']
+    nodes = dict(changes['node'])
+    order = nodes.pop(None, None)
+    return {
+        "mode": "delta",
+        "epoch": CHANGELOG.epoch,
+        "revision": revision,
+        "users": {
+            "set": {name: uuid for name, uuid in users.items() if uuid is not None},
+            "deleted": [name for name, uuid in users.items() if uuid is None]
+        },
+        "nodes": {
+            "set": [node for node in nodes.values() if node is not None],
+            "deleted": [name for name, node in nodes.items() if node is None],
+            "order": order
+        },
         "timestamp": time.time()
-    })
+    }
 
 @app.route('/api/v1/users', methods=['GET', 'POST'])
 def api_users():
@@ -190,22 +2896,99 @@ def api_users():
         return jsonify({"error": "Unauthorized"}), 401
     
     if request.method == 'GET':
-        return jsonify({"users": UserManager.get_users()})
+        return jsonify({"users": UserManager.snapshot_users()})
     
     elif request.method == 'POST':
-        data = request.json
-        username = data.get('username')
-        uuid = data.get('uuid')
+        data = request.get_json(silent=True) or {}
+        username = data.get('username') if isinstance(data, dict) else None
+        uuid = data.get('uuid') if isinstance(data, dict) else None
         
         if not username or not uuid:
             return jsonify({"error": "Missing username or uuid"}), 400
+        if not isinstance(username, str) or not isinstance(uuid, str):
+            return jsonify({"error": "username and uuid must be strings"}), 400
         
-        users = UserManager.get_users()
-        users[username] = uuid
-        UserManager.save_to_database(users)
+        UserManager.save_user(username, uuid)
         
         return jsonify({"status": "success", "user": username})
 
+def parse_batch_item(item):
+    """Turn one batch item into a store operation, or raise ValueError"""
+    if isinstance(item, ValueError):
+        raise item
+    if not isinstance(item, dict):
+        raise ValueError("Item must be an object")
+    op = item.get('op', 'upsert')
+    username = item.get('username')
+    if not username:
+        raise ValueError("Missing username")
+    if not isinstance(username, str):
+        raise ValueError("username must be a string")
+    if op == 'upsert':
+        uuid = item.get('uuid')
+        if not uuid:
+            raise ValueError("Missing uuid")
+        if not isinstance(uuid, str):
+            raise ValueError("uuid must be a string")
+        return ('set', username, uuid)
+    if op == 'delete':
+        return ('del', username, None)
+    raise ValueError(f"Unknown op: {op}")
+
+def read_batch_items():
+    """Yield batch items from an NDJSON stream or a JSON array body"""
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        # Parse line by line as the body streams in
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Reported against this item rather than failing the batch
+                yield ValueError("Invalid JSON")
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError("Body must be a JSON array or NDJSON")
+        yield from items
+
+@app.route('/api/v1/users/batch', methods=['POST'])
+def api_users_batch():
+    """Bulk upsert/delete users (master only)
+
+    Accepts a JSON array or NDJSON of {"op": "upsert"|"delete",
+    "username": ..., "uuid": ...} items. Valid items are applied in one
+    transaction; the response has one result per item, in order.
+    """
+    if CONFIG['NODE_TYPE'] != 'master':
+        return jsonify({"error": "This node is not a master"}), 403
+    
+    api_key = request.headers.get('X-API-Key')
+    if api_key != CONFIG['API_KEY']:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    results = []
+    operations = []
+    try:
+        for item in read_batch_items():
+            try:
+                operation = parse_batch_item(item)
+            except ValueError as e:
+                results.append({"username": item.get('username') if isinstance(item, dict) else None, "status": "error", "error": str(e)})
+                continue
+            results.append({"username": operation[1], "status": None})
+            operations.append((len(results) - 1, operation))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    statuses = UserManager.apply_batch([operation for _, operation in operations])
+    for (index, _), status in zip(operations, statuses):
+        results[index]["status"] = status
+    
+    changed = sum(1 for status in statuses if status in ('created', 'updated', 'deleted'))
+    return jsonify({"status": "success", "changed": changed, "results": results})
+
 @app.route('/api/v1/nodes', methods=['GET', 'POST'])
 def api_nodes():
     """Manage nodes (master only)"""
@@ -224,79 +3007,205 @@ def api_nodes():
         NodeManager.register_node(node_data)
         return jsonify({"status": "success"})
 
-# Subscription endpoints
-@app.route('/sub/<user>')
-def subscription(user):
-    """Generate subscription for user"""
-    users = UserManager.get_users()
-    client_id = users.get(user)
+@app.route('/api/v1/stats', methods=['GET', 'POST'])
+def api_stats():
+    """Traffic reports: nodes POST theirs (JWT), operators GET the overview (API key)"""
+    if CONFIG['NODE_TYPE'] == 'client':
+        return jsonify({"error": "This node is not a master or replica"}), 403
     
-    if not client_id:
-        return Response("User not found", status=404)
+    if request.method == 'GET':
+        api_key = request.headers.get('X-API-Key')
+        if api_key != CONFIG['API_KEY']:
+            return jsonify({"error": "Unauthorized"}), 401
+        return jsonify(NodeStats.overview())
     
-    configs = []
-    nodes = NodeManager.get_all_nodes()
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer ') or not UserManager.verify_token(auth_header.split(' ')[1]):
+        return jsonify({"error": "Unauthorized"}), 401
     
-    for node in nodes:
-        # All nodes now use TLS with proper domains
-        vless_url = f"vless://{client_id}@{node['host']}:{node['port']}?encryption=none&security=tls&sni={node['host']}&alpn=h2%2Chttp%2F1.1&type=tcp#{node['name']}"
-        configs.append(vless_url)
+    summary = request.get_json(silent=True)
+    if not isinstance(summary, dict) or not summary.get('node') or not isinstance(summary.get('top_users'), list):
+        return jsonify({"error": "Invalid report"}), 400
+    NodeStats.record(summary)
+    return jsonify({"status": "success"})
+
+# Subscription endpoints
+@app.route('/api/v1/promote', methods=['POST'])
+def api_promote():
+    """Promote a replica to master"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key != CONFIG['API_KEY']:
+        return jsonify({"error": "Unauthorized"}), 401
     
-    content = '\n'.join(configs)
-    encoded = base64.b64encode(content.encode()).decode()
+    if CONFIG['NODE_TYPE'] != 'replica':
+        return jsonify({"error": "Only a replica can be promoted"}), 409
     
-    return Response(encoded, mimetype='text/plain')
+    UserManager.promote()
+    return jsonify({"status": "success", "epoch": CHANGELOG.epoch, "revision": CHANGELOG.revision})
+
+@app.route('/sub/<user>')
+def subscription(user):
+    """Generate subscription for user"""
+    return subscription_response(user, raw_format=False)
 
 @app.route('/sub/<user>/raw')
 def subscription_raw(user):
     """Generate raw subscription"""
-    users = UserManager.get_users()
-    client_id = users.get(user)
-    
-    if not client_id:
-        return Response("User not found", status=404)
-    
-    configs = []
-    nodes = NodeManager.get_all_nodes()
-    
-    for node in nodes:
-        # All nodes now use TLS with proper domains
-        vless_url = f"vless://{client_id}@{node['host']}:{node['port']}?encryption=none&security=tls&sni={node['host']}&alpn=h2%2Chttp%2F1.1&type=tcp#{node['name']}"
-        configs.append(vless_url)
-    
-    return Response('\n'.join(configs), mimetype='text/plain')
+    return subscription_response(user, raw_format=True)
 
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    users = UserManager.get_users()
-    nodes = NodeManager.get_all_nodes()
+    snapshot = UserManager.current()
     
     return jsonify({
         "status": "ok",
         "node": CONFIG['NODE_NAME'],
         "type": CONFIG['NODE_TYPE'],
-        "users": len(users),
-        "nodes": len(nodes),
-        "cache_age": int(time.time() - CACHE.get('last_sync', 0))
+        "users": len(snapshot.users),
+        "nodes": len(snapshot.nodes),
+        "healthy_nodes": sum(1 for record in snapshot.records if NodeRanker.health_factor(record) > 0),
+        "cache_age": int(time.time() - snapshot.synced_at),
+        "node_health": HealthMonitor.report()
     })
 
 @app.route('/api/v1/metrics')
 def metrics():
     """Metrics endpoint for monitoring"""
+    lookups = Metrics.counter_value('vpnsub_user_cache_total')
+    hits = Metrics.counter_value('vpnsub_user_cache_total', result='hit')
+    snapshot = UserManager.current()
     return jsonify({
         "node": CONFIG['NODE_NAME'],
         "type": CONFIG['NODE_TYPE'],
-        "uptime": int(time.time()),
-        "users_count": len(UserManager.get_users()),
-        "nodes_count": len(NodeManager.get_all_nodes()),
-        "cache_hit_rate": CACHE.get('hit_rate', 0),
-        "last_sync": CACHE.get('last_sync', 0)
+        "uptime": int(time.time() - PROCESS_START),
+        "users_count": len(snapshot.users),
+        "nodes_count": len(snapshot.nodes),
+        "cache_hit_rate": round(hits / lookups, 4) if lookups else 0,
+        "sync_connections": {
+            "new": Metrics.counter_value('vpnsub_sync_connections_total', reused='false'),
+            "reused": Metrics.counter_value('vpnsub_sync_connections_total', reused='true')
+        },
+        "last_sync": snapshot.synced_at,
+        "node_health": HealthMonitor.report()
     })
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    node_health = HealthMonitor.report()
+    snapshot = UserManager.current()
+    gauges = {
+        'vpnsub_uptime_seconds': ('Seconds since this process started', [((), round(time.time() - PROCESS_START, 3))]),
+        'vpnsub_users': ('Users known to this node', [((), len(snapshot.users))]),
+        'vpnsub_nodes': ('Nodes known to this node', [((), len(snapshot.nodes))]),
+        'vpnsub_last_sync_timestamp_seconds': ('Unix time the served snapshot was synced or published', [((), snapshot.synced_at)]),
+        'vpnsub_revision': ('Change-log revision served or applied', [((), snapshot.revision)]),
+        'vpnsub_node_up': ('Node health as seen by the prober', [
+            ((('node', name),), int(state['healthy'])) for name, state in node_health.items()
+        ]),
+        'vpnsub_node_handshake_milliseconds': ('Latest TLS handshake latency per node', [
+            ((('node', name),), state['latency_ms']) for name, state in node_health.items()
+            if state['latency_ms'] is not None
+        ]),
+    }
+    node_stats = NodeStats.current()
+    if node_stats:
+        gauges['vpnsub_node_traffic_bytes_per_second'] = ('Traffic rate over the last reported slot', [
+            ((('node', name), ('direction', direction)), report['last'][f"{direction}_bps"])
+            for name, report in node_stats.items() for direction in ('up', 'down')
+        ])
+        gauges['vpnsub_node_active_users'] = ('Users with traffic in the last reported slot', [
+            ((('node', name),), report['last']['active_users']) for name, report in node_stats.items()
+        ])
+    return Response(Metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+def start_node():
+    """Per-process startup: initial sync, change feed and background jobs"""
+    if CONFIG['NODE_TYPE'] == 'master':
+        # Runs after fork: a respawned worker must not reuse the arbiter's epoch
+        CHANGELOG.restart()
+        FileWatcher.start()
+    else:
+        if WarmStart.load():
+            # Serve the local snapshot now and catch up with the master in the background
+            BackgroundRefresher.trigger()
+        else:
+            UserManager.sync_from_master()
+        if CONFIG['PUSH_UPDATES']:
+            UserManager.start_change_feed()
+    if CONFIG['HEALTH_CHECKS']:
+        HealthMonitor.start()
+    if CONFIG['STATS_COLLECT']:
+        TrafficCollector.start()
+    if CONFIG['EXPORT_DIR']:
+        StaticExporter.start()
+
+def gunicorn_options():
+    """Worker and concurrency settings for the prefork server
+
+    Clients run one worker per core; each worker keeps its own snapshot,
+    and only one of them long-polls the master (see follow_master), so no
+    state is shared between them. Masters and replicas stay at a single
+    worker because the user store and change log live in process memory;
+    threads cover the load, with LONG_POLL_WAITERS more on top for the
+    long-polls held open by client hosts.
+    gthread workers park idle keep-alive connections in a poller, so
+    thousands of polling subscribers don't each hold a thread.
+    """
+    workers = CONFIG['WORKERS'] or os.cpu_count() or 1
+    threads = CONFIG['THREADS']
+    if CONFIG['NODE_TYPE'] != 'client':
+        workers = 1
+        # A held long-poll sits idle on its thread; these threads do nothing else
+        threads += CONFIG['LONG_POLL_WAITERS']
+    return {
+        'bind': f"0.0.0.0:{CONFIG['PORT']}",
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'worker_connections': CONFIG['WORKER_CONNECTIONS'],
+        'keepalive': CONFIG['KEEPALIVE'],
+        # Long-polls hold a request open for up to LONG_POLL_TIMEOUT
+        'timeout': CONFIG['LONG_POLL_TIMEOUT'] + 30,
+        # Background threads don't survive fork, so start them in each worker
+        'post_fork': lambda server, worker: start_node()
+    }
+
+def serve_gunicorn():
+    """Run the app under gunicorn's prefork server"""
+    from gunicorn.app.base import BaseApplication
+
+    class SubscriptionServer(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options().items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    SubscriptionServer().run()
+
+def export_once(check):
+    """--export / --check-export: sync, export EXPORT_DIR once, optionally verify it"""
+    if not CONFIG['EXPORT_DIR']:
+        sys.exit("EXPORT_DIR is not set")
+    if CONFIG['NODE_TYPE'] != 'master' and not UserManager.sync_from_master():
+        sys.exit("Sync from master failed")
+    written, removed = StaticExporter.export()
+    print(f"Exported {written} subscriptions, removed {removed}")
+    if check:
+        mismatches = StaticExporter.check()
+        for path in mismatches[:20]:
+            print(f"Mismatch: {path}")
+        print(f"{len(mismatches)} files differ from the dynamic endpoint")
+        sys.exit(1 if mismatches else 0)
+
 if __name__ == '__main__':
-    # Initial sync for client nodes
-    if CONFIG['NODE_TYPE'] == 'client':
-        UserManager.sync_from_master()
-    
-    app.run(host='0.0.0.0', port=CONFIG['PORT'])
\ No newline at end of file
+    if '--export' in sys.argv or '--check-export' in sys.argv:
+        export_once('--check-export' in sys.argv)
+    elif CONFIG['SERVER_MODE'] == 'gunicorn':
+        serve_gunicorn()
+    else:
+        start_node()
+        app.run(host='0.0.0.0', port=CONFIG['PORT'], threaded=True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+X-UI database watcher - wakes the sync loops only when inbound clients change
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+class XUIDBWatcher:
+    """Detects changes to the client lists in x-ui.db
+
+    Polling is two-tiered so idle cost stays near zero. Every poll only
+    reads SQLite's data_version and the file's inode, which change on any
+    commit from another connection or a restored database. x-ui commits
+    traffic counters constantly, so when either moves we also hash the
+    raw `columns` (by default the client settings) of the watched
+    inbounds. Only a different hash counts as a change. Bursts of edits
+    are debounced: we wait until the database has been quiet for
+    `debounce` seconds, but never longer than `max_delay` after the first
+    change.
+    """
+
+    def __init__(self, db_path, where='1 = 1', poll_interval=1.0, debounce=2.0, max_delay=10.0, columns='settings'):
+        self.db_path = db_path
+        self.where = where
+        self.columns = columns
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.conn = None
+        self.inode = None
+        self.last_signature = None
+        self.last_fingerprint = self.fingerprint()
+
+    def connect(self):
+        """Open a persistent read-only connection; data_version is per connection"""
+        if self.conn is None:
+            self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        return self.conn
+
+    def signature(self):
+        """Cheap marker that moves whenever anything in the database changes"""
+        try:
+            inode = os.stat(self.db_path).st_ino
+            if self.conn is not None and inode != self.inode:
+                # Database file was replaced; our connection still sees the old one
+                self.conn.close()
+                self.conn = None
+            conn = self.connect()
+            self.inode = inode
+            return inode, conn.execute("PRAGMA data_version").fetchone()[0]
+        except (OSError, sqlite3.Error):
+            self.conn = None
+            return None
+
+    def fingerprint(self):
+        """Hash of the watched inbounds' columns, without parsing the JSON"""
+        self.last_signature = self.signature()
+        digest = hashlib.sha256()
+        try:
+            rows = self.connect().execute(f"SELECT id, {self.columns} FROM inbounds WHERE {self.where} ORDER BY id")
+            for row in rows:
+                for value in row:
+                    digest.update(str('' if value is None else value).encode())
+                    digest.update(b'\0')
+        except sqlite3.Error:
+            self.conn = None
+            return None
+        return digest.hexdigest()
+
+    def changed(self):
+        """True if the database committed since we last looked"""
+        return self.signature() != self.last_signature
+
+    def settle(self):
+        """Wait for a burst of edits to finish"""
+        first_change = time.monotonic()
+        while time.monotonic() - first_change < self.max_delay:
+            self.last_signature = self.signature()
+            time.sleep(self.debounce)
+            if not self.changed():
+                break
+
+    def wait_for_change(self, timeout=None):
+        """Block until the watched client lists change; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.changed():
+                fingerprint = self.fingerprint()
+                if fingerprint != self.last_fingerprint:
+                    self.settle()
+                    self.last_fingerprint = self.fingerprint()
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
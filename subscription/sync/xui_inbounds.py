@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+X-UI Inbound Publisher - Publishes this server's inbounds as link specs in nodes.json
+Subscription servers compile these specs into per-node link templates
+"""
+
+import sqlite3
+import json
+import requests
+import os
+from xui_db_watcher import XUIDBWatcher
+
+# Columns whose changes can change the links an inbound produces
+INBOUND_COLUMNS = 'port, protocol, listen, enable, stream_settings, settings'
+
+def first(value):
+    """Single value from a string-or-list header field"""
+    if isinstance(value, list):
+        return value[0] if value else ''
+    return value or ''
+
+def link_spec(protocol, port, listen, settings, stream_settings):
+    """Link-relevant parts of one inbound, or (None, reason) if it can't be linked
+
+    Only what a client URL needs is kept; the node's public host is added
+    by the subscription service, so the same spec works behind any name.
+    """
+    if protocol not in ('vless', 'vmess', 'trojan'):
+        return None, f"protocol {protocol} has no subscription link"
+    if listen and listen.startswith('127.'):
+        return None, "listens on loopback only"
+    if protocol == 'trojan':
+        # Links carry the synced id (the client's `id`) as the trojan password
+        clients = settings.get('clients', [])
+        if not clients or any(not client.get('password') or client.get('password') != client.get('id') for client in clients):
+            return None, "trojan client passwords are not their synced ids"
+
+    network = stream_settings.get('network', 'tcp')
+    security = stream_settings.get('security', 'none')
+    if network not in ('tcp', 'ws', 'grpc'):
+        return None, f"network {network} is not supported"
+    if security not in ('tls', 'none'):
+        return None, f"security {security} is not supported"
+
+    spec = {'protocol': protocol, 'port': port, 'network': network, 'security': security}
+    if security == 'tls':
+        tls = stream_settings.get('tlsSettings') or {}
+        spec['sni'] = tls.get('serverName', '')
+        spec['alpn'] = ','.join(tls.get('alpn') or [])
+        spec['fp'] = (tls.get('settings') or {}).get('fingerprint') or tls.get('fingerprint', '')
+    if network == 'tcp':
+        header = (stream_settings.get('tcpSettings') or {}).get('header') or {}
+        if header.get('type') == 'http':
+            request = header.get('request') or {}
+            spec['header_type'] = 'http'
+            spec['host'] = first((request.get('headers') or {}).get('Host'))
+            spec['path'] = first(request.get('path')) or '/'
+    elif network == 'ws':
+        ws = stream_settings.get('wsSettings') or {}
+        spec['path'] = ws.get('path') or '/'
+        spec['host'] = ws.get('host') or (ws.get('headers') or {}).get('Host', '')
+    elif network == 'grpc':
+        grpc = stream_settings.get('grpcSettings') or {}
+        spec['service_name'] = grpc.get('serviceName', '')
+        if grpc.get('multiMode'):
+            spec['mode'] = 'multi'
+    if protocol == 'vless':
+        flows = {client.get('flow', '') for client in settings.get('clients', [])}
+        if len(flows) == 1:
+            spec['flow'] = flows.pop()
+    # Empty fields fall back to defaults on the service side; keep nodes.json small
+    return {key: value for key, value in spec.items() if value not in ('', None)}, None
+
+class XUIInbounds:
+    def __init__(self):
+        self.xui_db = os.environ.get('XUI_DB', '/etc/x-ui/x-ui.db')
+        self.api_url = os.environ.get('NODES_API', 'http://localhost:5000/api/v1/nodes')
+        self.node_name = os.environ.get('NODE_NAME', 'Finland')
+        self.where = os.environ.get('XUI_INBOUNDS_WHERE', 'enable = 1')
+        self.session = requests.Session()
+        self.session.headers['X-API-Key'] = os.environ.get('API_KEY', '3e9ce1f3bccf221b6b3d6158d29f5c75294802deef0ed40f')
+
+    def read_db(self):
+        """Link specs for the inbounds in x-ui.db that match self.where"""
+        conn = sqlite3.connect(self.xui_db)
+        try:
+            rows = conn.execute(
+                f"SELECT port, protocol, listen, settings, stream_settings, remark FROM inbounds WHERE {self.where} ORDER BY id"
+            ).fetchall()
+        finally:
+            conn.close()
+        inbounds = [
+            (remark, protocol, port, listen, json.loads(settings or '{}'), json.loads(stream_settings or '{}'))
+            for port, protocol, listen, settings, stream_settings, remark in rows
+        ]
+        return self.specs(inbounds)
+
+    def read_config(self, path):
+        """Link specs for the inbounds in an xray config.json"""
+        with open(path, 'r') as f:
+            config = json.load(f)
+        inbounds = [
+            (inbound.get('tag', ''), inbound.get('protocol'), inbound.get('port'), inbound.get('listen'),
+             inbound.get('settings') or {}, inbound.get('streamSettings') or {})
+            for inbound in config.get('inbounds', [])
+        ]
+        return self.specs(inbounds)
+
+    def specs(self, inbounds):
+        """Convert (name, protocol, port, listen, settings, stream_settings) rows"""
+        specs = []
+        for name, protocol, port, listen, settings, stream_settings in inbounds:
+            spec, reason = link_spec(protocol, port, listen, settings, stream_settings)
+            if spec is None:
+                print(f"Skipping inbound {name or port}: {reason}")
+            else:
+                specs.append(spec)
+        return specs
+
+    def publish(self, specs):
+        """Store specs as this node's `inbounds` in nodes.json; True if they changed"""
+        response = self.session.get(self.api_url, timeout=10)
+        response.raise_for_status()
+        for node in response.json().get('nodes', []):
+            if node.get('name') == self.node_name:
+                break
+        else:
+            raise RuntimeError(f"Node {self.node_name} is not in nodes.json")
+        if node.get('inbounds') == specs:
+            return False
+        response = self.session.post(self.api_url, json=dict(node, inbounds=specs), timeout=10)
+        response.raise_for_status()
+        return True
+
+def main():
+    """Print or publish this server's link specs, once or on every inbound change"""
+    import sys
+
+    inbounds = XUIInbounds()
+    if '--config' in sys.argv:
+        # Read an xray config.json instead of x-ui.db, e.g. x-ui/bin/config.json
+        specs = inbounds.read_config(sys.argv[sys.argv.index('--config') + 1])
+        print(json.dumps(specs, indent=2))
+    elif '--watch' in sys.argv:
+        print(f"Publishing inbounds of {inbounds.node_name} in watch mode...")
+        watcher = XUIDBWatcher(inbounds.xui_db, where=inbounds.where, columns=INBOUND_COLUMNS)
+        while True:
+            try:
+                if inbounds.publish(inbounds.read_db()):
+                    print("Published changed inbounds")
+                watcher.wait_for_change(timeout=int(os.environ.get('XUI_RESYNC_INTERVAL', '3600')))
+            except Exception as e:
+                print(f"Error publishing inbounds: {e}")
+                watcher.wait_for_change(timeout=60)
+    else:
+        specs = inbounds.read_db()
+        if '--publish' in sys.argv:
+            print("Published" if inbounds.publish(specs) else "Unchanged")
+        print(json.dumps(specs, indent=2))
+
+if __name__ == '__main__':
+    main()
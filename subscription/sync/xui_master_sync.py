@@ -6,9 +6,171 @@ This ensures when you add a user in Finland's X-UI, it appears on all servers
 
 import sqlite3
 import json
+import hashlib
 import paramiko
-import time
+import threading
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xui_db_watcher import XUIDBWatcher
+
+def client_set_hash(clients):
+    """Hash of an {email: uuid} map; REMOTE_PROBE_SCRIPT computes the same"""
+    return hashlib.sha256(json.dumps(sorted(clients.items())).encode()).hexdigest()
+
+def settings_hash(settings):
+    """Hash of a settings object; REMOTE_PROBE_SCRIPT computes the same"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+# Runs on the remote with PARAMS bound: reports hashes of the inbound's
+# client list and stream settings, plus the list itself when asked
+REMOTE_PROBE_SCRIPT = '''
+import hashlib
+import json
+import sqlite3
+
+conn = sqlite3.connect(PARAMS['db_path'])
+row = conn.execute("SELECT settings, stream_settings FROM inbounds WHERE port = ?", (PARAMS['port'],)).fetchone()
+conn.close()
+
+clients = {}
+stream_settings = {}
+if row:
+    for client in json.loads(row[0]).get('clients', []):
+        clients[client.get('email', '')] = client.get('id', '')
+    stream_settings = json.loads(row[1] or '{}')
+
+result = {
+    'found': row is not None,
+    'hash': hashlib.sha256(json.dumps(sorted(clients.items())).encode()).hexdigest(),
+    'stream_hash': hashlib.sha256(json.dumps(stream_settings, sort_keys=True).encode()).hexdigest()
+}
+if PARAMS['include_clients']:
+    result['clients'] = clients
+print(json.dumps(result))
+'''
+
+# Runs on the remote with PARAMS bound: applies a client diff to x-ui.db,
+# then to the running xray via its API (rmu/adu) so existing tunnels stay
+# up, falling back to restarting x-ui when that isn't possible
+REMOTE_APPLY_SCRIPT = '''
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+
+removed = set(PARAMS['removed'])
+upserts = PARAMS['upserts']
+
+conn = sqlite3.connect(PARAMS['db_path'])
+row = conn.execute("SELECT id, protocol, tag, settings FROM inbounds WHERE port = ?", (PARAMS['port'],)).fetchone()
+inbound_id, protocol, tag, settings = row
+settings = json.loads(settings)
+
+clients = []
+changed = []
+for client in settings.get('clients', []):
+    email = client.get('email', '')
+    if email in removed:
+        continue
+    if email in upserts:
+        # Keep the client's other fields (limits, expiry) and swap the UUID
+        client['id'] = upserts[email]
+        changed.append(email)
+    clients.append(client)
+added = [
+    {"email": email, "enable": True, "id": uuid, "flow": ""}
+    for email, uuid in upserts.items() if email not in changed
+]
+clients.extend(added)
+settings['clients'] = clients
+settings.setdefault('decryption', 'none')
+settings.setdefault('fallbacks', [])
+
+if PARAMS['stream_settings'] is not None:
+    conn.execute("UPDATE inbounds SET settings = ?, stream_settings = ? WHERE id = ?",
+                 (json.dumps(settings), json.dumps(PARAMS['stream_settings']), inbound_id))
+else:
+    conn.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (json.dumps(settings), inbound_id))
+conn.commit()
+conn.close()
+
+def xray_api(*args):
+    command = [PARAMS['xray_bin'], 'api', args[0], '--server=' + PARAMS['api_server']] + list(args[1:])
+    return subprocess.run(command, capture_output=True, timeout=30).returncode == 0
+
+hot_reload = PARAMS['stream_settings'] is None and bool(tag) and os.path.exists(PARAMS['xray_bin'])
+if hot_reload and (removed or changed):
+    hot_reload = xray_api('rmu', '-tag=' + tag, *sorted(removed | set(changed)))
+if hot_reload and upserts:
+    fresh = [client for client in clients if client.get('email') in upserts]
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump({"inbounds": [{"tag": tag, "protocol": protocol, "settings": {"clients": fresh}}]}, f)
+    try:
+        hot_reload = xray_api('adu', f.name)
+    finally:
+        os.unlink(f.name)
+if not hot_reload:
+    subprocess.run(['systemctl', 'restart', 'x-ui'], timeout=60)
+
+print(json.dumps({
+    'added': len(added),
+    'removed': len(removed),
+    'changed': len(changed),
+    'hot_reload': hot_reload
+}))
+'''
+
+class SSHPool:
+    """Keeps one SSH connection per server open across sync cycles"""
+    
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+    
+    def get(self, server):
+        """Return a live connection to server, reconnecting if it dropped"""
+        key = (server['host'], server.get('port', 22))
+        with self.lock:
+            ssh = self.connections.get(key)
+        if ssh is not None:
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh
+            self.discard(server)
+        
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            server['host'],
+            port=server.get('port', 22),
+            username=server.get('username', 'root'),
+            key_filename=server['key_file'],
+            timeout=self.timeout,
+            banner_timeout=self.timeout,
+            auth_timeout=self.timeout
+        )
+        # Keepalives stop idle NAT/firewall state from silently dropping the connection between cycles
+        ssh.get_transport().set_keepalive(30)
+        with self.lock:
+            self.connections[key] = ssh
+        return ssh
+    
+    def discard(self, server):
+        """Close and forget a connection after an error"""
+        key = (server['host'], server.get('port', 22))
+        with self.lock:
+            ssh = self.connections.pop(key, None)
+        if ssh is not None:
+            ssh.close()
+    
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for ssh in connections:
+            ssh.close()
 
 class XUIMasterSync:
     def __init__(self):
@@ -22,6 +184,22 @@ class XUIMasterSync:
             }
             # Add more servers here as needed
         ]
+        # Servers synced at once, and seconds allowed per SSH operation
+        self.max_parallel = int(os.environ.get('SYNC_PARALLELISM', '8'))
+        self.host_timeout = int(os.environ.get('SYNC_HOST_TIMEOUT', '30'))
+        self.pool = SSHPool(self.host_timeout)
+        # Client list each server had after our last successful sync
+        self.remote_state = {}
+    
+    def run_remote(self, ssh, command, stdin_data=None):
+        """Run a command on the remote, returning (exit status, stdout, stderr)"""
+        stdin, stdout, stderr = ssh.exec_command(command, timeout=self.host_timeout)
+        if stdin_data is not None:
+            stdin.write(stdin_data)
+            stdin.channel.shutdown_write()
+        output = stdout.read().decode()
+        errors = stderr.read().decode()
+        return stdout.channel.recv_exit_status(), output, errors
     
     def get_master_users(self):
         """Get all VPN users from Finland master"""
@@ -43,84 +221,99 @@ class XUIMasterSync:
             print(f"Error reading master database: {e}")
         return users
     
+    def stream_settings_for(self, server):
+        """TLS stream settings the 8443 inbound should have on a server"""
+        # Determine certificate path based on server
+        if server['name'] == 'Bahrain':
+            cert_domain = 'bahrain.freedomacrossborders.shop'
+        else:
+            cert_domain = 'freedomacrossborders.shop'
+        
+        return {
+            "network": "tcp",
+            "security": "tls",
+            "tlsSettings": {
+                "serverName": cert_domain,
+                "certificates": [{
+                    "certificateFile": f"/etc/letsencrypt/live/{cert_domain}/fullchain.pem",
+                    "keyFile": f"/etc/letsencrypt/live/{cert_domain}/privkey.pem"
+                }],
+                "alpn": ["h2", "http/1.1"]
+            },
+            "tcpSettings": {
+                "header": {"type": "none"}
+            }
+        }
+    
+    def run_script(self, ssh, script, params):
+        """Run a remote script with PARAMS bound, returning its JSON output"""
+        source = f"PARAMS = __import__('json').loads({json.dumps(params)!r})\n{script}"
+        # Feed the script over stdin instead of writing a temp file first
+        status, output, errors = self.run_remote(ssh, "python3 -", source)
+        if status != 0:
+            raise RuntimeError(errors.strip() or f"remote script exited with {status}")
+        return json.loads(output)
+    
     def sync_to_remote(self, server, users):
-        """Sync users to a remote X-UI server"""
+        """Bring a remote X-UI server's client list in line with users
+
+        A cheap probe compares hashes first, so an up-to-date server costs
+        one tiny round trip. Otherwise only the adds, removals and UUID
+        changes are shipped. They are written to x-ui.db and hot-applied
+        to the running xray through its API, so live connections survive.
+        x-ui is restarted only when the hot path is unavailable or the
+        stream settings changed.
+        """
         try:
-            # Create SSH connection
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(server['host'], username='root', key_filename=server['key_file'])
+            ssh = self.pool.get(server)
+            stream_settings = self.stream_settings_for(server)
+            known = self.remote_state.get(server['name'])
             
-            # Create Python script to run on remote
-            clients = []
-            for email, uuid in users.items():
-                clients.append({
-                    "email": email,
-                    "enable": True,
-                    "id": uuid,
-                    "flow": ""
-                })
+            probe = self.run_script(ssh, REMOTE_PROBE_SCRIPT, {
+                'db_path': server['db_path'],
+                'port': 8443,
+                'include_clients': known is None
+            })
+            if not probe['found']:
+                return False, "no inbound on port 8443"
             
-            settings = {
-                "clients": clients,
-                "decryption": "none",
-                "fallbacks": []
-            }
+            stream_changed = probe['stream_hash'] != settings_hash(stream_settings)
+            if probe['hash'] == client_set_hash(users) and not stream_changed:
+                self.remote_state[server['name']] = dict(users)
+                return True, "unchanged"
             
-            # Determine certificate path based on server
-            if server['name'] == 'Bahrain':
-                cert_domain = 'bahrain.freedomacrossborders.shop'
+            if 'clients' in probe:
+                current = probe['clients']
+            elif probe['hash'] == client_set_hash(known):
+                current = known
             else:
-                cert_domain = 'freedomacrossborders.shop'
+                # Someone edited the remote; fetch its real client list
+                current = self.run_script(ssh, REMOTE_PROBE_SCRIPT, {
+                    'db_path': server['db_path'],
+                    'port': 8443,
+                    'include_clients': True
+                })['clients']
             
-            stream_settings = {
-                "network": "tcp",
-                "security": "tls",
-                "tlsSettings": {
-                    "serverName": cert_domain,
-                    "certificates": [{
-                        "certificateFile": f"/etc/letsencrypt/live/{cert_domain}/fullchain.pem",
-                        "keyFile": f"/etc/letsencrypt/live/{cert_domain}/privkey.pem"
-                    }],
-                    "alpn": ["h2", "http/1.1"]
-                },
-                "tcpSettings": {
-                    "header": {"type": "none"}
-                }
-            }
+            removed = sorted(email for email in current if email not in users)
+            upserts = {email: uuid for email, uuid in users.items() if current.get(email) != uuid}
+            result = self.run_script(ssh, REMOTE_APPLY_SCRIPT, {
+                'db_path': server['db_path'],
+                'port': 8443,
+                'removed': removed,
+                'upserts': upserts,
+                'stream_settings': stream_settings if stream_changed else None,
+                'xray_bin': server.get('xray_bin', '/usr/local/x-ui/bin/xray-linux-amd64'),
+                'api_server': server.get('api_server', '127.0.0.1:62789')
+            })
             
-            # Update remote database
-            update_script = f'''
-import sqlite3
-import json
-
-settings = {json.dumps(settings)}
-stream_settings = {json.dumps(stream_settings)}
-
-conn = sqlite3.connect('{server["db_path"]}')
-cursor = conn.cursor()
-cursor.execute("UPDATE inbounds SET settings = ?, stream_settings = ? WHERE port = 8443", 
-               (json.dumps(settings), json.dumps(stream_settings)))
-conn.commit()
-conn.close()
-print("Updated {len(clients)} users")
-'''
-            
-            # Write script to remote
-            stdin, stdout, stderr = ssh.exec_command(f"cat > /tmp/sync_users.py << 'EOF'\n{update_script}\nEOF")
-            stdout.read()
-            
-            # Execute script
-            stdin, stdout, stderr = ssh.exec_command("python3 /tmp/sync_users.py")
-            output = stdout.read().decode()
-            
-            # Restart X-UI
-            stdin, stdout, stderr = ssh.exec_command("systemctl restart x-ui")
-            
-            ssh.close()
-            return True, output
+            self.remote_state[server['name']] = dict(users)
+            how = "hot reload" if result['hot_reload'] else "x-ui restart"
+            return True, f"+{result['added']} -{result['removed']} ~{result['changed']} via {how}"
             
         except Exception as e:
+            # Don't reuse a connection or cached state in an unknown condition
+            self.pool.discard(server)
+            self.remote_state.pop(server['name'], None)
             return False, str(e)
     
     def sync_all(self):
@@ -129,14 +322,19 @@ print("Updated {len(clients)} users")
         print(f"Found {len(users)} users on master")
         
         results = []
-        for server in self.remote_servers:
-            print(f"Syncing to {server['name']}...")
-            success, message = self.sync_to_remote(server, users)
-            if success:
-                print(f"  ✓ {server['name']}: {message}")
-            else:
-                print(f"  ✗ {server['name']}: {message}")
-            results.append({'server': server['name'], 'success': success})
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            futures = {
+                executor.submit(self.sync_to_remote, server, users): server
+                for server in self.remote_servers
+            }
+            for future in as_completed(futures):
+                server = futures[future]
+                success, message = future.result()
+                if success:
+                    print(f"  ✓ {server['name']}: {message}")
+                else:
+                    print(f"  ✗ {server['name']}: {message}")
+                results.append({'server': server['name'], 'success': success})
         
         return results
 
@@ -145,14 +343,23 @@ def main():
     
     sync = XUIMasterSync()
     
-    if len(sys.argv) > 1 and sys.argv[1] == '--watch':
-        print("Starting X-UI master sync in watch mode...")
-        while True:
-            sync.sync_all()
-            time.sleep(300)  # Sync every 5 minutes
-    else:
-        results = sync.sync_all()
-        print(f"\nSync complete: {sum(1 for r in results if r['success'])}/{len(results)} successful")
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == '--watch':
+            print("Starting X-UI master sync in watch mode...")
+            watcher = XUIDBWatcher(sync.master_db, where='port = 8443',
+                                   debounce=float(os.environ.get('XUI_WATCH_DEBOUNCE', '2')))
+            resync_interval = int(os.environ.get('XUI_RESYNC_INTERVAL', '3600'))
+            while True:
+                # SSH connections stay open between iterations
+                results = sync.sync_all()
+                # Sync again as soon as clients change; retry failed servers after a minute
+                failed = any(not r['success'] for r in results)
+                watcher.wait_for_change(timeout=60 if failed else resync_interval)
+        else:
+            results = sync.sync_all()
+            print(f"\nSync complete: {sum(1 for r in results if r['success'])}/{len(results)} successful")
+    finally:
+        sync.pool.close_all()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
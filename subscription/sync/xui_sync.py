@@ -6,105 +6,218 @@ X-UI Integration Module - Syncs X-UI users with subscription service
 import sqlite3
 import json
 import requests
-import time
 import os
 from datetime import datetime
+from xui_db_watcher import XUIDBWatcher
 
 class XUISync:
     def __init__(self):
         self.xui_db = '/etc/x-ui/x-ui.db'
         self.api_url = 'http://localhost:5000/api/v1/users'
         self.api_key = os.environ.get('API_KEY', '3e9ce1f3bccf221b6b3d6158d29f5c75294802deef0ed40f')
+        # One pooled keep-alive connection for every call to the subscription service
+        self.session = requests.Session()
+        self.session.headers['X-API-Key'] = self.api_key
+        # Users that are not in X-UI but must never be deleted by reconciliation
+        self.keep = {u for u in os.environ.get('XUI_SYNC_KEEP', '').split(',') if u}
+        # Deletion safety limit: the larger of a fixed floor and a share of all users
+        self.min_delete_limit = int(os.environ.get('XUI_SYNC_MIN_DELETE_LIMIT', '5'))
+        self.max_delete_ratio = float(os.environ.get('XUI_SYNC_MAX_DELETE_RATIO', '0.2'))
         
-    def get_xui_users(self):
-        """Get all users from X-UI database"""
-        users = {}
+    def read_xui_clients(self):
+        """Read every client from X-UI as {username: (uuid, enabled)}
+
+        A client counts as enabled if it is enabled in at least one enabled
+        inbound. Raises on database errors so callers never mistake a
+        failed read for an empty user list.
+        """
+        clients = {}
+        conn = sqlite3.connect(self.xui_db)
         try:
-            conn = sqlite3.connect(self.xui_db)
             cursor = conn.cursor()
             
-            # Get inbounds (VPN configurations)
-            cursor.execute("SELECT settings FROM inbounds WHERE enable = 1")
+            # Get inbounds (VPN configurations), disabled ones included
+            cursor.execute("SELECT settings, enable FROM inbounds")
             inbounds = cursor.fetchall()
             
-            for inbound in inbounds:
-                settings = json.loads(inbound[0])
-                if 'clients' in settings:
-                    for client in settings['clients']:
-                        email = client.get('email', '')
-                        uuid = client.get('id', '')
-                        if email and uuid:
-                            # Use email as username (remove domain if present)
-                            username = email.split('@')[0] if '@' in email else email
-                            users[username] = uuid
-            
+            for settings, inbound_enabled in inbounds:
+                settings = json.loads(settings)
+                for client in settings.get('clients', []):
+                    email = client.get('email', '')
+                    uuid = client.get('id', '')
+                    if email and uuid:
+                        # Use email as username (remove domain if present)
+                        username = email.split('@')[0] if '@' in email else email
+                        enabled = bool(inbound_enabled) and client.get('enable', True) is not False
+                        if username in clients and clients[username][1] and not enabled:
+                            continue
+                        clients[username] = (uuid, enabled)
+        finally:
             conn.close()
-            return users
+        return clients
+    
+    def get_xui_users(self):
+        """Get all enabled users from X-UI database"""
+        try:
+            return {
+                username: uuid
+                for username, (uuid, enabled) in self.read_xui_clients().items()
+                if enabled
+            }
         except Exception as e:
             print(f"Error reading X-UI database: {e}")
             return {}
     
     def get_subscription_users(self):
-        """Get users from subscription service"""
+        """Get users from subscription service, or None if unavailable"""
         try:
-            headers = {'X-API-Key': self.api_key}
-            response = requests.get(self.api_url, headers=headers, timeout=5)
+            response = self.session.get(self.api_url, timeout=5)
             if response.status_code == 200:
                 return response.json().get('users', {})
         except Exception as e:
             print(f"Error getting subscription users: {e}")
-        return {}
+        return None
     
     def add_user_to_subscription(self, username, uuid):
         """Add user to subscription service"""
         try:
-            headers = {
-                'X-API-Key': self.api_key,
-                'Content-Type': 'application/json'
-            }
             data = {'username': username, 'uuid': uuid}
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=5)
+            response = self.session.post(self.api_url, json=data, timeout=5)
             return response.status_code == 200
         except Exception as e:
             print(f"Error adding user {username}: {e}")
             return False
     
-    def sync_users(self):
-        """Sync X-UI users to subscription service"""
-        xui_users = self.get_xui_users()
-        sub_users = self.get_subscription_users()
-        
-        added = []
-        for username, uuid in xui_users.items():
-            if username not in sub_users:
-                if self.add_user_to_subscription(username, uuid):
-                    added.append(username)
-                    print(f"Added user: {username}")
-        
+    def apply_batch(self, items):
+        """Send upserts/deletes to the subscription service in one request
+
+        Returns the per-item results, or None if the request failed.
+        """
+        try:
+            response = self.session.post(f"{self.api_url}/batch", json=items, timeout=60)
+            if response.status_code == 200:
+                return response.json().get('results', [])
+            print(f"Batch update failed: HTTP {response.status_code}")
+        except Exception as e:
+            print(f"Error sending batch update: {e}")
+        return None
+    
+    def plan(self, xui_clients, sub_users):
+        """Diff X-UI clients against the subscription store
+
+        Enabled X-UI clients should exist with the same UUID; disabled ones
+        and ones gone from X-UI should not exist, except usernames listed
+        in XUI_SYNC_KEEP (users managed outside X-UI).
+        """
+        desired = {username: uuid for username, (uuid, enabled) in xui_clients.items() if enabled}
         return {
-            'xui_users': len(xui_users),
-            'sub_users': len(sub_users),
-            'added': added,
+            'add': {u: uuid for u, uuid in desired.items() if u not in sub_users},
+            'update': {u: uuid for u, uuid in desired.items() if u in sub_users and sub_users[u] != uuid},
+            'disable': sorted(u for u in sub_users if u in xui_clients and u not in desired),
+            'remove': sorted(u for u in sub_users if u not in xui_clients and u not in self.keep)
+        }
+    
+    def delete_limit(self, sub_count):
+        """Most deletions one sync may apply without --force"""
+        return max(self.min_delete_limit, int(sub_count * self.max_delete_ratio))
+    
+    def sync_users(self, dry_run=False, force=False):
+        """Reconcile the subscription service with X-UI in one batch
+
+        Adds new clients, propagates UUID rotations and deletes users that
+        were disabled or removed in X-UI. If the deletions exceed the
+        safety limit they are held back (and reported) unless force is set,
+        so a truncated or mis-read x-ui.db can't wipe the user base.
+        """
+        result = {
+            'xui_users': 0,
+            'sub_users': 0,
+            'added': [],
+            'updated': [],
+            'deleted': [],
+            'blocked_deletes': [],
+            'dry_run': dry_run,
             'timestamp': datetime.now().isoformat()
         }
+        try:
+            xui_clients = self.read_xui_clients()
+        except Exception as e:
+            print(f"Error reading X-UI database: {e}")
+            result['error'] = 'xui_unavailable'
+            return result
+        sub_users = self.get_subscription_users()
+        if sub_users is None:
+            result['error'] = 'subscription_unavailable'
+            return result
+        
+        plan = self.plan(xui_clients, sub_users)
+        deletes = plan['disable'] + plan['remove']
+        result['xui_users'] = sum(1 for _, enabled in xui_clients.values() if enabled)
+        result['sub_users'] = len(sub_users)
+        result['plan'] = {
+            'add': sorted(plan['add']),
+            'update': sorted(plan['update']),
+            'disable': plan['disable'],
+            'remove': plan['remove'],
+            'delete_limit': self.delete_limit(len(sub_users))
+        }
+        
+        if len(deletes) > self.delete_limit(len(sub_users)) and not force:
+            print(f"Refusing to delete {len(deletes)} of {len(sub_users)} users (limit "
+                  f"{self.delete_limit(len(sub_users))}); re-run with --force if intended")
+            result['blocked_deletes'] = deletes
+            deletes = []
+        
+        items = [
+            {'op': 'upsert', 'username': username, 'uuid': uuid}
+            for username, uuid in {**plan['add'], **plan['update']}.items()
+        ] + [{'op': 'delete', 'username': username} for username in deletes]
+        if dry_run or not items:
+            return result
+        
+        results = self.apply_batch(items)
+        if results is None:
+            result['error'] = 'batch_failed'
+            return result
+        
+        for item in results:
+            status = item.get('status')
+            key = {'created': 'added', 'updated': 'updated', 'deleted': 'deleted'}.get(status)
+            if key:
+                result[key].append(item['username'])
+                print(f"{key.capitalize()} user: {item['username']}")
+        return result
 
 def main():
     """Run sync once or continuously"""
     import sys
     
     sync = XUISync()
+    force = '--force' in sys.argv
     
-    if len(sys.argv) > 1 and sys.argv[1] == '--watch':
-        # Continuous sync mode
+    if '--dry-run' in sys.argv:
+        # Report what a sync would change without applying it
+        result = sync.sync_users(dry_run=True, force=force)
+        print(json.dumps(result, indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == '--watch':
+        # Continuous sync mode: re-sync when x-ui.db clients change, plus a slow safety net
         print("Starting X-UI sync in watch mode...")
+        watcher = XUIDBWatcher(sync.xui_db, where='enable = 1',
+                               debounce=float(os.environ.get('XUI_WATCH_DEBOUNCE', '2')))
+        resync_interval = int(os.environ.get('XUI_RESYNC_INTERVAL', '3600'))
         while True:
-            result = sync.sync_users()
-            if result['added']:
-                print(f"Synced {len(result['added'])} new users")
-            time.sleep(60)  # Sync every minute
+            result = sync.sync_users(force=force)
+            changed = len(result['added']) + len(result['updated']) + len(result['deleted'])
+            if changed:
+                print(f"Synced {changed} user changes")
+            # Sync again as soon as clients change; retry a failed sync after a minute
+            failed = 'error' in result
+            if failed:
+                print(f"Sync failed ({result['error']}), retrying in 60s")
+            watcher.wait_for_change(timeout=60 if failed else resync_interval)
     else:
         # One-time sync
-        result = sync.sync_users()
+        result = sync.sync_users(force=force)
         print(json.dumps(result, indent=2))
 
 if __name__ == '__main__':